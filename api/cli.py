@@ -0,0 +1,54 @@
+import sys
+import json
+import argparse
+
+from loguru import logger
+
+from cda_classes.pipeline_service import ClimateDataService, RequestRejected, load_models
+
+# Usage (from the repository root):
+#   python -m api.cli "Show me the temperature in Berlin in 2020" "..."
+#   python -m api.cli --request request.json --output result.json
+# Every prompt runs through extraction, download and analysis, the results
+# are written as one JSON list.
+
+
+def run(service, prompt=None, fields=None):
+    try:
+        if prompt is not None:
+            request, review_message = service.prepare_request(prompt)
+        else:
+            request, review_message = service.request_from_fields(fields)
+    except RequestRejected as e:
+        return {"prompt": prompt, "error": " ".join(e.message.split())}
+
+    try:
+        result = service.run_request(request)
+    except Exception as e:
+        logger.exception("The request could not be processed")
+        return {"prompt": prompt, "error": str(e)}
+
+    return {"prompt": prompt, "review": review_message, **service.result_to_json(result)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run requests of the Climate Data Agent")
+    parser.add_argument("prompts", nargs="*", help="prompts in natural language")
+    parser.add_argument("--request", help="JSON file with the fields of a request")
+    parser.add_argument("--output", help="file for the results, stdout by default")
+    args = parser.parse_args()
+
+    if not args.prompts and not args.request:
+        parser.error("Give at least one prompt or --request")
+
+    service = ClimateDataService(*load_models())
+    results = [run(service, prompt=prompt) for prompt in args.prompts]
+    if args.request:
+        with open(args.request) as request_file:
+            results.append(run(service, fields=json.load(request_file)))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
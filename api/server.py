@@ -0,0 +1,135 @@
+import json
+import time
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+
+from cda_classes.job_manager import JOB_DONE, JOB_FAILED, JobManager
+from cda_classes.pipeline_service import ClimateDataService, RequestRejected, load_models
+
+API_HOST = "0.0.0.0"
+API_PORT = 8000
+
+# Seconds between two looks at a job when the client waits for the result
+API_POLL_SECONDS = 1.0
+
+# Usage (from the repository root): python -m api.server --port 8000
+#
+#   POST /requests   {"prompt": "..."} or {"request": {"location": [...], "time_ranges":
+#                    [["01/01/2020", "31/12/2020"]], "climate_data": "Temperature",
+#                    "analysis_type": "basic_analysis"}}, optional "wait": true
+#                    -> 202 {"job_id", "review"}, 200 with the result if waited,
+#                       422 {"error"} if the request cannot be processed
+#   GET /jobs/<id>   -> {"job_id", "status", "progress", "result" or "error"}
+#   GET /health      -> {"status": "ok"}
+
+
+# Class to serve the pipeline of one ClimateDataService over HTTP, the jobs
+# run in the JobManager so identical requests are processed once
+class PipelineServer(ThreadingHTTPServer):
+    def __init__(self, server_address, service, job_manager):
+        super().__init__(server_address, PipelineRequestHandler)
+        self.service = service
+        self.job_manager = job_manager
+        # the prompt manager keeps state between the agents of one prompt
+        self.prepare_lock = threading.Lock()
+
+
+class PipelineRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path.startswith("/jobs/"):
+            job = self.server.job_manager.get(self.path[len("/jobs/"):])
+            if job is None:
+                self._send_json(404, {"error": "Unknown job"})
+            else:
+                self._send_json(200, self._job_to_json(job))
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/requests":
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except (ValueError, UnicodeDecodeError):
+            self._send_json(400, {"error": "The body must be JSON"})
+            return
+
+        if not isinstance(body, dict):
+            self._send_json(400, {"error": "The body must be a JSON object"})
+            return
+        if "prompt" in body and not isinstance(body["prompt"], str):
+            self._send_json(400, {"error": "'prompt' must be a string"})
+            return
+        if "prompt" not in body and not isinstance(body.get("request"), dict):
+            self._send_json(400, {"error": "Either 'prompt' or a 'request' object is needed"})
+            return
+
+        service = self.server.service
+        try:
+            with self.server.prepare_lock:
+                if "prompt" in body:
+                    request, review_message = service.prepare_request(body["prompt"])
+                else:
+                    request, review_message = service.request_from_fields(body["request"])
+        except RequestRejected as e:
+            self._send_json(422, {"error": " ".join(e.message.split())})
+            return
+        except Exception as e:
+            logger.exception("The request could not be prepared")
+            self._send_json(422, {"error": f"The request could not be processed: {e}"})
+            return
+
+        job = self.server.job_manager.submit(
+            request.request_hash(), service.run_request_job, request
+        )
+
+        if not body.get("wait", False):
+            self._send_json(202, {"job_id": job.job_id, "review": review_message})
+            return
+
+        while not job.is_finished():
+            time.sleep(API_POLL_SECONDS)
+        self._send_json(200 if job.status == JOB_DONE else 500, self._job_to_json(job))
+
+    def _job_to_json(self, job):
+        job_json = {
+            "job_id": job.job_id,
+            "status": job.status,
+            "progress": job.progress,
+        }
+        if job.status == JOB_DONE:
+            job_json["result"] = self.server.service.result_to_json(job.result)
+        elif job.status == JOB_FAILED:
+            job_json["error"] = str(job.error)
+        return job_json
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP API of the Climate Data Agent")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    args = parser.parse_args()
+
+    server = PipelineServer(
+        (args.host, args.port), ClimateDataService(*load_models()), JobManager()
+    )
+    logger.info(f"Serving the Climate Data Agent on {args.host}:{args.port}")
+    server.serve_forever()
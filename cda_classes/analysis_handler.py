@@ -1,14 +1,151 @@
+import os
+import warnings
+import threading
+import multiprocessing
 import numpy as np
 import pandas as pd
+import xarray as xr
 import plotly.graph_objs as go
 import plotly.express as px
 
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from dateutil.relativedelta import relativedelta
 from loguru import logger
 from prophet import Prophet
+from prophet.serialize import model_from_json, model_to_json
 from datetime import datetime
 from utils.utils import Utilities, apply_timing_decorator
 from .eorequest import EORequest
+from .forecast_cache import ForecastCache
+from .spatial_aggregation import SpatialAggregator
+
+# Shared by all analyses, so the area weights of each grid are computed once
+SPATIAL_AGGREGATOR = SpatialAggregator()
+
+# Fitted models of earlier predictions, shared by all analyses
+FORECAST_CACHE = ForecastCache()
+
+# Frequency the training data of the predictions is averaged to before the
+# Prophet fit, "daily" or "monthly". Hourly ERA5-Land data would give Prophet
+# 24 rows per day, far more than a forecast over years needs.
+PREDICTION_FREQUENCY = "daily"
+
+PREDICTION_FREQUENCIES = {
+    "daily": {"unit": "datetime64[D]", "pandas_freq": "D", "per_year": 365, "name": "days"},
+    "monthly": {"unit": "datetime64[M]", "pandas_freq": "MS", "per_year": 12, "name": "months"},
+}
+
+# Number of processes fitting the Prophet models of the sub-requests in
+# parallel, 1 fits them one after another in-process
+PREDICTION_WORKERS = min(4, os.cpu_count() or 1)
+
+# Seconds to wait for the forecast of one sub-request
+PREDICTION_TIMEOUT = 600
+
+# The pool is shared by all AnalysisHandlers and created on first use
+_prediction_executor = None
+_prediction_executor_lock = threading.Lock()
+
+
+def resample_mean(times, values, unit):
+    """
+    Average a series over the periods of a numpy datetime unit (e.g.
+    "datetime64[D]"), without formatting the timestamps. Missing values are
+    left out, periods without any value are dropped.
+
+    Returns:
+        tuple: The start of every period (datetime64[ns]) and its mean.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    periods = np.asarray(times).astype(unit)
+    period_starts, period_idx = np.unique(periods, return_inverse=True)
+
+    is_valid = ~np.isnan(values)
+    sums = np.bincount(period_idx, weights=np.where(is_valid, values, 0.0), minlength=len(period_starts))
+    counts = np.bincount(period_idx, weights=is_valid, minlength=len(period_starts))
+
+    has_values = counts > 0
+    return (
+        period_starts[has_values].astype("datetime64[ns]"),
+        sums[has_values] / counts[has_values],
+    )
+
+
+def fit_forecast(df, periods, freq="D"):
+    """
+    Fit a Prophet model to the training data and forecast the given number
+    of periods. Runs in the worker processes of the prediction pool.
+
+    Returns:
+        tuple: The fitted model as JSON and the forecast of Prophet
+        (ds, yhat, yhat_lower, ...).
+    """
+    model = Prophet()
+    model.fit(df)
+    future = model.make_future_dataframe(periods=periods, freq=freq)
+    return model_to_json(model), model.predict(future)
+
+
+def extend_forecast(model_json, periods, freq="D"):
+    """
+    Forecast the given number of periods with an already fitted model.
+
+    Returns:
+        tuple: The model as JSON and the forecast of Prophet.
+    """
+    model = model_from_json(model_json)
+    future = model.make_future_dataframe(periods=periods, freq=freq)
+    return model_json, model.predict(future)
+
+
+def get_prediction_executor():
+    global _prediction_executor
+    # Spawned workers do not inherit the state of the LLM process
+    with _prediction_executor_lock:
+        if _prediction_executor is None:
+            _prediction_executor = ProcessPoolExecutor(
+                max_workers=PREDICTION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _prediction_executor
+
+
+def recycle_prediction_executor(executor):
+    """
+    Replace a pool with a stuck worker: later forecasts get a new pool,
+    the queued forecasts of the old one are cancelled and its workers
+    exit once their current fit is done.
+    """
+    global _prediction_executor
+    with _prediction_executor_lock:
+        if _prediction_executor is executor:
+            _prediction_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Class with the statistics of the spatial mean series of all sub-requests of a
+# request. The series are stacked into one NaN padded (sub_request, step) array,
+# so each statistic is one reduction for all locations and time ranges together.
+class BatchStatistics():
+    def __init__(self, series_list):
+        # at least one step, so empty series give NaN statistics like pandas
+        steps = max([len(series) for series in series_list] + [1])
+        values = np.full((len(series_list), steps), np.nan)
+        for idx, series in enumerate(series_list):
+            values[idx, :len(series)] = series
+
+        self.series = xr.DataArray(values, dims=["sub_request", "step"])
+        with warnings.catch_warnings():
+            # all-NaN series (e.g. only sea points) warn on every reduction
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            self.minimum = self.series.min("step").values
+            self.maximum = self.series.max("step").values
+            self.mean = self.series.mean("step").values
+            # sample standard deviation like pandas
+            self.std = self.series.std("step", ddof=1).values
+        self.range = self.maximum - self.minimum
+
 
 # class to handle the different ways of visualizing the user request
 @apply_timing_decorator
@@ -31,19 +168,24 @@ class AnalysisHandler:
     def basic_analysis(self, eo_request: EORequest):
         figures = []
         messages = []
-        for request in eo_request.collected_sub_requests:
-            df = self.get_monthly_mean_dataframe(request)
-            
-            # creating statistics
-            minval, maxval = self.get_min_max_from_dataframe(df)
-            avgval = df["y"].mean()
-            
+        dataframes = [
+            self.get_monthly_mean_dataframe(request)
+            for request in eo_request.collected_sub_requests
+        ]
+        
+        # creating statistics of all sub-requests at once
+        statistics = BatchStatistics([df["y"].values for df in dataframes])
+        minvals = Utilities.significant_round(statistics.minimum, 4)
+        maxvals = Utilities.significant_round(statistics.maximum, 4)
+        stds = Utilities.significant_round(statistics.std, 4)
+        
+        for idx, df in enumerate(dataframes):
             figure = self.get_plot_from_dataframe(
                 df,
                 f"{eo_request.variable_long_name} [{eo_request.variable_units}]",
             )
             message = self.get_basic_analysis_string(
-                minval, maxval, self.get_std_from_dataframe(df), avgval,
+                minvals[idx], maxvals[idx], stds[idx], statistics.mean[idx],
                 eo_request.variable_units
             )
             figures.append(figure)
@@ -55,16 +197,33 @@ class AnalysisHandler:
     def predictions(self, eo_request: EORequest):
         figures = []
         messages = []
-        
-        for request in eo_request.collected_sub_requests:
-            df = self._get_dataframe_from_eorequest(request)
-            model = Prophet()
-
-            model.fit(df)
-            periods = request.timeframe_object.prediction_number * 365
-            future = model.make_future_dataframe(periods=periods)
-            forecast = model.predict(future)
+        sub_requests = eo_request.collected_sub_requests
+        frequency = PREDICTION_FREQUENCIES[PREDICTION_FREQUENCY]
+        dataframes = [
+            self.get_training_dataframe(request, frequency["unit"])
+            for request in sub_requests
+        ]
+        periods_list = [
+            request.timeframe_object.prediction_number * frequency["per_year"]
+            for request in sub_requests
+        ]
+        cache_keys = [
+            FORECAST_CACHE.key(
+                request.abbox,
+                request.variable_shortname,
+                request.timeframe_object.startdate,
+                request.timeframe_object.enddate,
+                df,
+            )
+            for request, df in zip(sub_requests, dataframes)
+        ]
+        forecasts = self.fit_forecasts(
+            dataframes, periods_list, cache_keys, freq=frequency["pandas_freq"]
+        )
 
+        for request, df, periods, forecast in zip(
+            sub_requests, dataframes, periods_list, forecasts
+        ):
             highest_value = self.round_to_sig_figs(forecast["yhat"].max(), 3)
             lowest_value = self.round_to_sig_figs(forecast["yhat"].min(), 3)
 
@@ -73,7 +232,7 @@ class AnalysisHandler:
                 f"{eo_request.variable_long_name} data provided. The forecast"
                 f"covers the period from **{request.timeframe_object.prediction_startdate.date()}** "
                 f"to **{request.timeframe_object.prediction_enddate.date()}** "
-                f"and spans a total of **{periods} days**.\n\n"
+                f"and spans a total of **{periods} {frequency['name']}**.\n\n"
                 f"You can expect the following key insights:\n\n"
                 f"- **Highest Predicted Value**: {highest_value} {eo_request.variable_units}\n"
                 f"- **Lowest Predicted Value**: {lowest_value} {eo_request.variable_units}\n"
@@ -145,6 +304,66 @@ class AnalysisHandler:
 
         return figures, messages
 
+    def fit_forecasts(
+        self, dataframes, periods_list, cache_keys=None, freq="D", workers=None, timeout=None
+    ):
+        """
+        Forecast every training dataframe. Cached models are reused, for a
+        longer horizon than the cached one they only predict again. The models
+        left to fit run in the prediction pool if there is more than one of
+        them and more than one worker.
+
+        Returns:
+            list: The forecasts in the order of the dataframes.
+        """
+        workers = PREDICTION_WORKERS if workers is None else workers
+        timeout = PREDICTION_TIMEOUT if timeout is None else timeout
+        cache_keys = cache_keys or [None] * len(dataframes)
+
+        forecasts = [None] * len(dataframes)
+        tasks = {}
+        for idx, (df, periods, key) in enumerate(zip(dataframes, periods_list, cache_keys)):
+            cached_forecast = FORECAST_CACHE.get(key) if key else None
+            if cached_forecast is None:
+                tasks[idx] = (fit_forecast, df, periods, freq)
+            else:
+                forecasts[idx] = cached_forecast.forecast_for(periods)
+                if forecasts[idx] is None:
+                    tasks[idx] = (extend_forecast, cached_forecast.model_json, periods, freq)
+        logger.info(
+            f"{len(dataframes) - len(tasks)} of {len(dataframes)} forecasts from the cache"
+        )
+
+        if workers <= 1 or len(tasks) <= 1:
+            results = {idx: task[0](*task[1:]) for idx, task in tasks.items()}
+        else:
+            executor = get_prediction_executor()
+            futures = {idx: executor.submit(*task) for idx, task in tasks.items()}
+            results = {}
+            for idx, future in futures.items():
+                try:
+                    results[idx] = future.result(timeout=timeout)
+                except TimeoutError:
+                    logger.error(
+                        f"The forecast of sub-request {idx + 1} timed out after "
+                        f"{timeout} seconds, recycling the prediction pool"
+                    )
+                    recycle_prediction_executor(executor)
+                    raise TimeoutError(
+                        f"The forecast of sub-request {idx + 1} took longer than {timeout} seconds"
+                    )
+                except (BrokenProcessPool, CancelledError):
+                    # the pool was recycled after the timeout of another request
+                    logger.warning(f"Fitting the forecast of sub-request {idx + 1} in-process")
+                    results[idx] = tasks[idx][0](*tasks[idx][1:])
+            logger.info(f"Fitted {len(results)} forecasts in parallel")
+
+        for idx, (model_json, forecast) in results.items():
+            if cache_keys[idx]:
+                FORECAST_CACHE.put(cache_keys[idx], model_json, periods_list[idx], forecast)
+            forecasts[idx] = forecast
+        return forecasts
+
     # creating the comparison
     def comparison(self, eo_request: EORequest):
         figures = []
@@ -164,10 +383,15 @@ class AnalysisHandler:
                 f"Below is a summary of the "
                 f"key statistics for each location:\n"
             )
-            for sub_request, color in zip(
-                eo_request.collected_sub_requests, self.colors
-            ):
-                df = self._get_dataframe_from_eorequest(sub_request)
+            dataframes = [
+                self._get_dataframe_from_eorequest(sub_request)
+                for sub_request in eo_request.collected_sub_requests
+            ]
+            statistics = BatchStatistics([df["y"].values for df in dataframes])
+            
+            for idx, (sub_request, df, color) in enumerate(zip(
+                eo_request.collected_sub_requests, dataframes, self.colors
+            )):
                 fig = self.get_plotly_figure_multi_loc(
                     fig,
                     df,
@@ -177,11 +401,11 @@ class AnalysisHandler:
                     eo_request.variable_units,
                 )
 
-                # Calculate the statistics for each location
-                avg_value = df["y"].mean()
-                min_value = df["y"].min()
-                max_value = df["y"].max()
-                range_value = max_value - min_value
+                # Statistics of the current location
+                avg_value = statistics.mean[idx]
+                min_value = statistics.minimum[idx]
+                max_value = statistics.maximum[idx]
+                range_value = statistics.range[idx]
                 # Append statistics for the current location
                 message += (
                     f"- **Location**: {sub_request.location}\n"
@@ -226,18 +450,25 @@ class AnalysisHandler:
                 f"Below is a summary of the key statistics for each time range:\n"
             )
 
+            dataframes = [
+                self._get_dataframe_from_eorequest(sub_request)
+                for sub_request in eo_request.collected_sub_requests
+            ]
+            statistics = BatchStatistics([df["y"].values for df in dataframes])
+
             # Iterate over each request and generate the plot
-            for sub_request in eo_request.collected_sub_requests:
-                df = self._get_dataframe_from_eorequest(sub_request)
+            for idx, (sub_request, df) in enumerate(zip(
+                eo_request.collected_sub_requests, dataframes
+            )):
                 start_date = sub_request.timeframe_object.startdate.date()
                 end_date = sub_request.timeframe_object.enddate.date()
                 time_ranges.append(f"{start_date}-{end_date}")
 
-                # Calculate the statistics for each time range
-                avg_value = df["y"].mean()
-                min_value = df["y"].min()
-                max_value = df["y"].max()
-                range_value = max_value - min_value
+                # Statistics of the current time range
+                avg_value = statistics.mean[idx]
+                min_value = statistics.minimum[idx]
+                max_value = statistics.maximum[idx]
+                range_value = statistics.range[idx]
 
                 # Select a color that hasn't been used yet
                 for color in self.colors:
@@ -293,12 +524,26 @@ class AnalysisHandler:
         df = pd.DataFrame(
             {
                 "ds": ds_filtered["time"].dt.strftime("%Y-%m-%d").values,
-                "y": ds_filtered.mean(dim=["latitude", "longitude"]).values,
+                "y": SPATIAL_AGGREGATOR.spatial_mean(ds_filtered).values,
             }
         )
 
         return df
 
+    def get_training_dataframe(self, request, unit):
+        """
+        Spatial mean series of a sub-request, averaged to the periods of
+        the numpy datetime unit, as training data for Prophet.
+        """
+        ds_filtered = self._get_filtered_dataset(request)
+        times, values = resample_mean(
+            ds_filtered["time"].values,
+            SPATIAL_AGGREGATOR.spatial_mean(ds_filtered).values,
+            unit,
+        )
+
+        return pd.DataFrame({"ds": times, "y": values})
+
     def _get_filtered_dataset(self, request):
 
         start_date = datetime.strftime(
@@ -379,19 +624,9 @@ class AnalysisHandler:
         """
         ds_filtered = self._get_filtered_dataset(request)
         # Extract year and month from time coordinates for labeling
-        try:
-
-            # Attempt to group by month and calculate the monthly mean
-            months = ds_filtered["time"].dt.strftime("%Y-%m-%d").values
-            monthly_means = (
-                ds_filtered.groupby("time.month")
-                .mean(dim=["latitude", "longitude"])
-                .values
-            )
-        except ValueError:
-            # If grouping by month fails (e.g., time only has days), compute mean over available time range
-            months = ds_filtered["time"].dt.strftime("%Y-%m-%d").values
-            monthly_means = ds_filtered.mean(dim=["latitude", "longitude"]).values
+        months = ds_filtered["time"].dt.strftime("%Y-%m-%d").values
+        # area weighted mean of every time step
+        monthly_means = SPATIAL_AGGREGATOR.spatial_mean(ds_filtered).values
 
         # Create a DataFrame with the results
         df = pd.DataFrame({"time": months, "y": monthly_means})
@@ -413,17 +648,6 @@ class AnalysisHandler:
 
         return figure
 
-    def get_min_max_from_dataframe(self, df: pd.DataFrame):
-        minima = df["y"].min()
-        maxima = df["y"].max()
-        return Utilities.significant_round(minima, 4), Utilities.significant_round(
-            maxima, 4
-        )
-
-    def get_std_from_dataframe(self, df: pd.DataFrame):
-        standard_deviation = df["y"].std()
-        return Utilities.significant_round(standard_deviation, 4)
-
     def get_basic_analysis_string(
         self, minval: float, maxval: float, std: float, avg: float, unit: str
         ):
@@ -457,12 +681,9 @@ class AnalysisHandler:
 
         for idx, dataset in enumerate(filtered_datasets):
             months = dataset["time"].dt.strftime("%Y-%m-%d").values
-            monthly_means = (
+            monthly_means = SPATIAL_AGGREGATOR.spatial_mean(
                 dataset.sel(new_dim=idx)
-                .groupby("time.month")
-                .mean(dim=["latitude", "longitude"])
-                .values
-            )
+            ).values
 
             df = pd.DataFrame(
                 {f"time_{idx + 1}": months, f"value_{idx + 1}": monthly_means}
@@ -478,8 +699,8 @@ class AnalysisHandler:
 
         fig.add_trace(
             go.Scatter(
-                x=df[f"ds"],
-                y=df[f"y"],
+                x=df["ds"],
+                y=df["y"],
                 mode="lines",
                 name=f"{location}",
                 line=dict(color=color),  # Set the color for each trace
@@ -1,42 +1,51 @@
-import gc
-from datetime import datetime
+import time
 
-import regex as re
 import streamlit as st
-import torch
 from loguru import logger
-from rapidfuzz import fuzz, process
-from sentence_transformers import SentenceTransformer, util
 
-from cda_classes.analysis_handler import AnalysisHandler
-from cda_classes.eorequest import EORequest
-from cda_classes.llm_processor import LargeLanguageModelProcessor
-from cda_classes.prompt_manager import PromptManager
-from cda_classes.visualisation_handler import VisualisationHandler
-from data_handler.data_handler import DataHandler
+from cda_classes.job_manager import JOB_FAILED, JobManager
+from cda_classes.pipeline_service import (
+    DEBUGMODE,
+    ClimateDataService,
+    RequestRejected,
+    load_models,
+)
 from utils.utils import apply_timing_decorator
 
-DEBUGMODE = False
+# Seconds between two looks at the state of a background job
+JOB_POLL_SECONDS = 1.0
+
+# Show location, time range, variable and analysis type while the combined
+# answer is generated, and stop the generation if none of them was found
+STREAM_EXTRACTION = True
+
+EXTRACTED_FIELD_LABELS = {
+    "location": "Location",
+    "time_ranges": "Time range",
+    "climate_data": "Variable",
+    "analysis_type": "Analysis",
+}
 
 # Load Model with cache resource to not reload the llm each time streamlits reruns
 @st.cache_resource
 def load_llm():
-    torch.cuda.empty_cache()
-    gc.collect()
-    llm = LargeLanguageModelProcessor()
-    sbert = SentenceTransformer("paraphrase-MiniLM-L6-v2")
-    return llm, sbert
+    return load_models()
+
+
+# One job manager for all sessions, so identical requests are processed once
+@st.cache_resource
+def load_job_manager():
+    return JobManager()
 
 
+# Streamlit client of the ClimateDataService, shows the messages
+# of the pipeline and the results of its jobs in the chat
 @apply_timing_decorator
 class Chatbot:
     def __init__(self):
-        self.llama3, self.sbert = load_llm()
-        self.prompt_manager = PromptManager(self.llama3)
-        self.data_handler = DataHandler()
-        self.vis_handler = VisualisationHandler()
-        self.analysis_handler = AnalysisHandler()
-        self.request = EORequest()
+        self.service = ClimateDataService(*load_llm())
+        self.job_manager = load_job_manager()
+        self.request = None
 
         if DEBUGMODE:
             with st.chat_message("assistant"):
@@ -48,232 +57,121 @@ class Chatbot:
                     """
                 )
 
-    # Step 0 - check if climate context is provided
-    def check_request(self, user_prompt):
-        self.request.request_type = self.prompt_manager.retrieve_information(
-            "request_type_agent", user_prompt
-        )
-
-    def extract_information(self, user_prompt):
-
-        # Step 1 - get location
-        self.request.request_locations = self.prompt_manager.retrieve_information(
-            "location_agent", user_prompt
-        )
-        self.request.request_locations = self.search_and_check_all_loc(
-            self.request.request_locations, user_prompt
-        )
-
-        # Step 2 - get time interval
-        time_contexts = self.prompt_manager.retrieve_information(
-            "time_context_extractor_agent", user_prompt
-        )
-
-        if any(context is None or context == "None" for context in time_contexts):
+    def process_request(self, user_prompt):
+        previous_request = None
+        if st.session_state.past_request:
+            previous_request = st.session_state.past_request[-1]
 
-            # If there is None or 'None' in the list, create a new list with one entry and return it
-            self.request.request_timeframes = [
-                "None"
-            ]  # Replace 'default_time_entry' with your desired entry
-        else:
-            for time_context in time_contexts:
-                self.request.process_and_store_timeframe(
-                    self.prompt_manager.retrieve_information(
-                        "time_range_extraction_agent", time_context
-                    )
-                )
+        on_field = None
+        if STREAM_EXTRACTION:
+            with st.chat_message("assistant"):
+                self.extraction_placeholder = st.empty()
+            self.extracted_fields = {}
+            on_field = self._show_extracted_field
 
-        # Step 3 - get product type
-        self.request.request_product = self.prompt_manager.retrieve_information(
-            "product_agent", user_prompt
-        )
-        if len(self.request.request_product) > 1:
-            multi_variable_edge_case_message = (
-                """
-                    Please note that I can only process one 
-                    climate variable at a time. For the best results, 
-                    kindly provide a single variable in your request.
-                """
-            )
-            st.write(multi_variable_edge_case_message)
-            st.session_state.messages.append(
-                {
-                    "role": "assistant",
-                    "request_info": multi_variable_edge_case_message
-                 }
+        try:
+            self.request, review_message = self.service.prepare_request(
+                user_prompt, previous_request, on_field
             )
+        except RequestRejected as e:
+            # incomplete requests are completed by the next prompt
+            if e.request is not None:
+                st.session_state.past_request.append(e.request)
+            self.show_assistant_message(e.message)
             st.stop()
-            
-        # Step 4 - get specific product name
-        if (
-            self.request.request_product[0] != "None"
-            and self.request.request_product[0] != None
-        ):
 
-            self.prompt_manager.specific_product_list = (
-                self.request.construct_product_agent_instruction()
-            )
-            self.request.request_specific_product = (
-                self.prompt_manager.retrieve_information(
-                    "specific_product_agent", user_prompt
-                )
-            )
+        if not DEBUGMODE:
+            st.session_state.past_request.append(self.request)
+            self.show_assistant_message(review_message, unsafe_allow_html=True)
 
-        # Step 5 - get analysis type
-        self.request.request_analysis = self.prompt_manager.retrieve_information(
-            "analysis_agent", user_prompt
+        # data download, data processing and analysis run in the background,
+        # the job survives reruns and is shared with identical requests
+        job = self.job_manager.submit(
+            self.request.request_hash(), self.service.run_request_job, self.request
         )
+        if job.job_id not in st.session_state.pending_jobs:
+            st.session_state.pending_jobs.append(job.job_id)
+        self.show_pending_jobs()
 
-        # Step 5.1 - if one location and comparison is detected then try to find the two different time ranges
-        if self.request.request_analysis[0] == "comparison":
-            self.request.multi_loc_request = True
-            
-            if len(self.request.request_locations) == 1:
-                self.request.multi_time_request = True
-                self.request.multi_loc_request = False
-
-        self.request.post_process_request_variables()
+    def show_assistant_message(self, message, unsafe_allow_html=False):
+        with st.chat_message("assistant"):
+            st.markdown(message, unsafe_allow_html=unsafe_allow_html)
+        st.session_state.messages.append(
+            {
+                "role": "assistant", 
+                "request_info": message
+            }
+        )
 
-    # setting message block for assistant in the case of callback to user
-    def callback_user(self, user_prompt):
-        if self.request.request_valid:
-            self.prompt_manager.callback_assistant_to_user(
-                "review_agent", user_prompt, self.request
+    # show each field of the combined answer as soon as it is generated,
+    # returns False to cancel the generation when the request is clearly invalid
+    def _show_extracted_field(self, field, value):
+        if field not in EXTRACTED_FIELD_LABELS:
+            return True
+        
+        values = value if isinstance(value, list) else [value]
+        self.extracted_fields[field] = [
+            " to ".join(item) if isinstance(item, list) else str(item)
+            for item in values
+            if item not in ["None", None]
+        ]
+        
+        self.extraction_placeholder.markdown(
+            "\n".join(
+                f"- **{EXTRACTED_FIELD_LABELS[known_field]}:** {', '.join(known_values)}"
+                for known_field, known_values in self.extracted_fields.items()
+                if known_values
             )
-            with st.chat_message("assistant"):
-                st.markdown(self.prompt_manager.callback, unsafe_allow_html=True)
-                st.session_state.messages.append(
-                    {
-                        "role": "assistant", 
-                        "request_info": self.prompt_manager.callback
-                    }
-                )
-            pass
-        else:
-            with st.chat_message("assistant"):
-                self.prompt_manager.callback_assistant_to_user(
-                    "missing_info_agent", user_prompt, self.request.errors
-                )
-                st.write(self.prompt_manager.callback)
-                st.session_state.messages.append(
-                    {
-                        "role": "assistant", 
-                        "request_info": self.prompt_manager.callback
-                    }
-                )
-                st.stop()
-
-    def process_request(self, user_prompt):
-        self.request.user_prompt = user_prompt
+        )
         
-        if not DEBUGMODE:
-            self.check_request(user_prompt)
-            
-            if (len(st.session_state.past_request) >= 1) and (
-                not st.session_state.past_request[-1].request_valid
-            ):
-
-                combined_prompt = (
-                    f"{user_prompt} and {st.session_state.past_request[-1].user_prompt}"
-                )
-                self.extract_information(combined_prompt)
-                user_prompt = combined_prompt
-
-            elif (
-                self.request.request_type[0] == False
-                or self.request.request_type[0] == "False"
-            ):
-                if len(st.session_state.past_request) < 1:
-                    self.check_climate_context()
-                elif st.session_state.past_request[-1].request_valid:
-                    self.check_climate_context()
-            else:
-                self.extract_information(user_prompt)
-
-            self.request.process_request()
-            # If the product was not found, prompt the user
-            if (
-                self.request.product_found == False
-                and self.request.request_product[0] != "None"
-            ):
-                self.request.load_variable_topics_list()
-                # Create a formatted message with bullet points
-                bullet_points = "\n".join(
-                    f"- {climate_topic}"
-                    for climate_topic in self.request.climate_topics
-                )  # Join with newline for bullet points
-                requested_product_in_query = self._detect_similar_product_in_user_query(
-                    user_prompt, self.request.request_product[0]
-                )
-                not_available_topic_message = (
-                    f"""
-                        The requested product '{requested_product_in_query}' was not found. 
-                        Please provide a valid variable from the collection:\n{bullet_points}
-                    """
-                )
-                # Display the message to the user with bullet points
-                st.write(not_available_topic_message)
-                st.session_state.messages.append(
-                    {
-                        "role": "assistant", 
-                        "request_info": not_available_topic_message
-                    }
-                )
-                st.stop()
-
-            self.analysis_compatability()
-
-            # data download, data processing, analysis...
-            st.session_state.past_request.append(self.request)
-
-            self.callback_user(user_prompt)
-
-        with st.spinner("Downloading Data..."):
-
-            if DEBUGMODE:
-                self.request.populate_dummy_data()
-            else:
-                self.request.collect_eorequests()
-
-                self.data_handler.download(self.request)
-                self.request.store_and_process_data()
-                self.animation = self.vis_handler.visualise_data(self.request)
-
-        analysis_type = self.request.request_analysis[0]
-        if isinstance(analysis_type, str) and not (
-            analysis_type == None or analysis_type == ""
-        ):
-            match (analysis_type):
-                case "basic_analysis":
-                    figures, analysis_texts = self.analysis_handler.basic_analysis(
-                        self.request
-                        )
-
-                case "comparison":
-                    figures, analysis_texts = self.analysis_handler.comparison(
-                        self.request
-                    )
-
-                case "predictions":
-                    figures, analysis_texts = self.analysis_handler.predictions(
-                        self.request
-                    )
+        # nothing to search for, the analysis type does not matter
+        return not all(
+            field in self.extracted_fields and not self.extracted_fields[field]
+            for field in ["location", "time_ranges", "climate_data"]
+        )
 
-                case "significant_event_detection":
-                    figures, analysis_texts = (
-                        self.analysis_handler.significant_event_detection(self.request)
-                    )
+    # wait for the jobs of this session and show their results, a rerun
+    # interrupts the waiting but not the jobs, they are polled again
+    def show_pending_jobs(self):
+        for job_id in list(st.session_state.pending_jobs):
+            job = self.job_manager.get(job_id)
+            if job is None:
+                logger.warning(f"Job {job_id} is no longer available")
+                st.session_state.pending_jobs.remove(job_id)
+                continue
+
+            if not job.is_finished():
+                with st.spinner("Downloading Data..."):
+                    download_progress = st.progress(0.0)
+                    while not job.is_finished():
+                        download_progress.progress(job.progress, text=job.progress_text)
+                        time.sleep(JOB_POLL_SECONDS)
+                    download_progress.empty()
+
+            st.session_state.pending_jobs.remove(job_id)
+            self.show_job_result(job)
+
+    def show_job_result(self, job):
+        if job.status == JOB_FAILED:
+            job_failed_message = (
+                """
+                    Sorry, the data for your request could not be 
+                    processed. Please try again later.
+                """
+            )
+            self.show_assistant_message(job_failed_message)
+            return
 
-                case _:
-                    analysis_texts = (
-                        "Unexpected type of analysis provided! Received:"
-                        + analysis_type
-                    )
-                    logger.error(analysis_texts)
+        self.request = job.result["request"]
+        self.animation = job.result["animation"]
+        figures = job.result["figures"]
+        analysis_texts = job.result["analysis_texts"]
+        tab_names = job.result["tab_names"]
+        analysis_header = job.result["analysis_header"]
 
+        if figures is not None:
             with st.chat_message("assistant"):
 
-                tab_names, analysis_header = self.create_tab_names(len(figures))
                 st.header(analysis_header)
                 tabs = st.tabs(tab_names)
 
@@ -298,9 +196,6 @@ class Chatbot:
                     }
                 )
 
-        else:
-            logger.info("No analysis type was present.")
-
         if self.request.request_analysis[0] == "predictions":
             pass
         else:
@@ -319,7 +214,11 @@ class Chatbot:
                         {', '.join(self.request.request_locations)}
                     """
                 )
-                if st.button("Generate Animation", on_click=self.output_animation):
+                if st.button(
+                    "Generate Animation", 
+                    key=f"animation_{job.job_id}", 
+                    on_click=self.output_animation,
+                ):
                     st.write("your animation")
 
     # Function to generate animation after clicking the button
@@ -339,273 +238,3 @@ class Chatbot:
     def replace_last_entry(self):
         if st.session_state.past_request:
             st.session_state.past_request[-1] = self.request
-
-    # Function to output unclear request to user
-    def check_climate_context(self):
-        with st.chat_message("assistant"):
-            non_climate_data = (
-                """
-                    Thanks for your request. 
-                    However there is no climate context. 
-                    Please provide more accurate information.
-                """
-            )
-            st.write(non_climate_data)
-            st.session_state.messages.append(
-                {
-                    "role": "assistant", 
-                    "request_info": non_climate_data
-                }
-            )
-            st.stop()
-
-    # Algorithm to delete found location and 
-    # check for another location in prompt
-    def search_and_check_all_loc(self, locations, user_prompt):
-        threshold = 70  # Define your threshold for fuzzy matching
-
-        # Loop until no location is found
-        while locations and locations[0] not in ["None", None]:
-            # Convert found locations to lowercase for case-insensitive comparison
-            found_locations_lower = [loc.lower() for loc in locations]
-
-            # Split the user prompt into words and convert to lowercase
-            words_in_prompt = [word.lower() for word in user_prompt.split()]
-
-            # Track matches to remove from the prompt
-            matches_to_remove = []
-
-            # Fuzzy matching to find best matches for found locations
-            for loc in found_locations_lower:
-                match, score, _ = process.extractOne(loc, words_in_prompt, scorer=fuzz.token_sort_ratio)
-                if score >= threshold:
-                    matches_to_remove.append(loc)
-                    print(f"Match: {loc} with score: {score}")
-
-            # Clean the user prompt based on found matches
-            cleaned_prompt = user_prompt
-            for match in matches_to_remove:
-                # Remove matched terms from cleaned_prompt
-                cleaned_prompt = re.sub(
-                    r"\b" + re.escape(match) + r"\b[,\s!?.]*",
-                    "",
-                    cleaned_prompt,
-                    flags=re.IGNORECASE,
-                )
-
-            # Handle leftover punctuation and whitespace
-            cleaned_prompt = re.sub(r"\band\b[,\s]*", "", cleaned_prompt, flags=re.IGNORECASE)
-            cleaned_prompt = re.sub(r"\s*,\s*", ", ", cleaned_prompt)  # Normalize commas
-            cleaned_prompt = re.sub(r",\s*$", "", cleaned_prompt)  # Remove trailing commas
-            cleaned_prompt = re.sub(r"\s+", " ", cleaned_prompt)  # Remove extra spaces
-            cleaned_prompt = cleaned_prompt.strip()  # Trim whitespace
-
-            print("Cleaned Prompt:", cleaned_prompt)
-
-            # Retrieve new locations from the cleaned prompt
-            found_location = self.prompt_manager.retrieve_information("location_agent", cleaned_prompt)
-            
-            if found_location:  # Ensure found_location is not empty
-                is_location = self.prompt_manager.retrieve_information("binary_location_detection", found_location[0])
-
-                if is_location[0] == "False":
-                    return locations  # Exit if no valid location is found
-                else:
-                    # Check if the new found location is not already in the existing found locations
-                    if found_location[0].lower() not in found_locations_lower:
-                        locations.append(found_location[0])  # Add new location
-
-        return locations  # Return updated locations list
-
-    # checks if the user is using wrong analysis types regarding to the timeframe
-    # For Example: User says Prediction for the past -> contradiction causes user callback
-    def analysis_compatability(self):
-        now = datetime.now()
-        cutoff_year_past = 1950  # Define the cutoff year as 1950
-        # Define the cutoff date as July 1, 2024
-        cutoff_date_present = datetime(2024, 8, 1)
-
-        if self.request.request_timeframes[0] != "None":
-            for timeframe in self.request.request_timeframes:
-                # Check for basic_analysis or comparison
-                if (
-                    self.request.request_analysis[0] == "basic_analysis"
-                    or self.request.request_analysis[0] == "comparison"
-                ):
-                    if (
-                        timeframe.startdate.year >= cutoff_date_present.year
-                        or timeframe.enddate.year >= cutoff_date_present.year
-                    ):
-                        with st.chat_message("assistant"):
-                            analysis_incompatability = (
-                                f"""
-                                    The {self.request.request_analysis[0]} 
-                                    cannot be shown for the current date 
-                                    and beyond (after 2024). 
-                                    Please try another time frame.
-                                    """
-                            )
-                            st.write(analysis_incompatability)
-                            st.session_state.messages.append(
-                                {
-                                    "role": "assistant",
-                                    "request_info": analysis_incompatability,
-                                }
-                            )
-                            st.stop()
-                    # Check if the timeframe includes years earlier than 1950
-                    elif (
-                        timeframe.startdate.year < cutoff_year_past
-                        or timeframe.enddate.year < cutoff_year_past
-                    ):
-                        with st.chat_message("assistant"):
-                            analysis_incompatibility = (
-                                f"""
-                                    The {self.request.request_analysis[0]} 
-                                    cannot be shown for years before 1950. 
-                                    Please try another timeframe.
-                                    """
-                            )
-                            st.write(analysis_incompatibility)
-                            st.session_state.messages.append(
-                                {
-                                    "role": "assistant",
-                                    "request_info": analysis_incompatibility,
-                                }
-                            )
-                            st.stop()
-
-                # Check for predictions
-                elif self.request.request_analysis[0] == "predictions":
-                    if (
-                        timeframe.prediction_startdate.year < cutoff_date_present.year
-                        or timeframe.prediction_enddate.year < cutoff_date_present.year
-                    ):
-                        with st.chat_message("assistant"):
-                            analysis_incompatability = (
-                                f"""
-                                    The {self.request.request_analysis[0]} 
-                                    cannot be shown for previous years before 2024. 
-                                    Please try a timeframe towards the future!
-                                """
-                            )
-                            st.write(analysis_incompatability)
-                            st.session_state.messages.append(
-                                {
-                                    "role": "assistant",
-                                    "request_info": analysis_incompatability,
-                                }
-                            )
-                            st.stop()
-
-    # Create Tab names for the request to split it up into different subrequest e.g. multiple locations
-    def create_tab_names(self, len_figures):
-        if self.request.request_analysis[0] == "basic_analysis":
-            tab_names = []
-            for sub_request in self.request.collected_sub_requests:
-                if (
-                    sub_request.timeframe_object.startdate.year
-                    != sub_request.timeframe_object.enddate.year
-                ):
-                    tab_name = (
-                        f"{sub_request.location} {sub_request.timeframe_object.startdate.year}-"
-                        f"{sub_request.timeframe_object.enddate.year}"
-                    )
-
-                else:
-                    tab_name = (
-                        f"{sub_request.location} "
-                        f"{sub_request.timeframe_object.startdate.year}"
-                    )
-                tab_names.append(tab_name)
-            analysis_header = "Basic Analysis"
-            return tab_names, analysis_header
-
-        elif self.request.request_analysis[0] == "predictions":
-            tab_names = [
-                (
-                    f"{self.request.collected_sub_requests[i].location} "
-                    f"{self.request.collected_sub_requests[i].timeframe_object.prediction_startdate.year}-"
-                    f"{self.request.collected_sub_requests[i].timeframe_object.prediction_enddate.year}"
-                )
-                for i in range(len_figures)
-            ]
-            analysis_header = "Prediction"
-            return tab_names, analysis_header
-
-        elif (
-            self.request.request_analysis[0] == "comparison"
-            and self.request.multi_loc_request
-        ):
-            # Concatenate location names and date ranges into a single tab
-            locations = " vs. ".join(
-                [
-                    sub_request.location
-                    for sub_request in self.request.collected_sub_requests
-                ]
-            )
-            if (
-                self.request.collected_sub_requests[0].timeframe_object.startdate.year
-                != self.request.collected_sub_requests[0].timeframe_object.enddate.year
-            ):
-                date_ranges = (
-                        f"{self.request.collected_sub_requests[0].timeframe_object.startdate.year}-"
-                        f"{self.request.collected_sub_requests[0].timeframe_object.enddate.year}"
-                )
-                
-            else:
-                date_ranges = (
-                        f"{self.request.collected_sub_requests[0].timeframe_object.startdate.year}"
-                )
-                
-            tab_names = [f"{locations} in {date_ranges}"]
-            analysis_header = "Comparison over Location"
-            
-            return tab_names, analysis_header
-        
-        elif (
-            self.request.request_analysis[0] == "comparison"
-            and self.request.multi_time_request
-        ):
-            # Concatenate timeframes into a single tab 
-            # (assuming the same location for multiple timeframes)
-            location = self.request.collected_sub_requests[0].location
-            date_ranges = []  # To accumulate the formatted date ranges
-
-            for sub_request in self.request.collected_sub_requests:
-                if (
-                    sub_request.timeframe_object.startdate.year
-                    != sub_request.timeframe_object.enddate.year
-                ):
-                    date_range = (
-                        f"""
-                        {sub_request.timeframe_object.startdate.year}-
-                        {sub_request.timeframe_object.enddate.year}
-                        """
-                    )
-                else:
-                    date_range = f"{sub_request.timeframe_object.startdate.year}"
-
-                date_ranges.append(date_range)  # Add the formatted range to the list
-
-            # Concatenate the date ranges with ' vs. ' to show comparison
-            concatenated_date_ranges = " vs. ".join(date_ranges)
-            
-            tab_names = [f"{location} {concatenated_date_ranges}"]
-            analysis_header = "Comparison over Time"
-            return tab_names, analysis_header
-
-    def _detect_similar_product_in_user_query(self, user_prompt, product):
-        # Load a lightweight SBERT model
-
-        # Get embeddings for the sentence tokens
-        sentence_embeddings = self.sbert.encode(user_prompt.split())
-        target_embedding = self.sbert.encode([product])
-
-        # Compute cosine similarity between the target word and sentence words
-        similarities = util.cos_sim(target_embedding, sentence_embeddings)
-        print(
-            f"Most similar word to '{product}' is: {user_prompt.split()[similarities.argmax()]}"
-        )
-
-        return user_prompt.split()[similarities.argmax()]
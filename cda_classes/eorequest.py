@@ -1,17 +1,20 @@
-import random
-import string
 import xarray as xr
 import numpy as np
 import math
+import json
+import hashlib
 import calendar
 
-from geopy.geocoders import Nominatim
 from datetime import datetime, timedelta
 from utils.utils import Utilities, TimeSpan, SubRequest
+from cda_classes.geocoder import Geocoder
 from loguru import logger
 from collections.abc import Iterable
 from collections import defaultdict
 
+# Shared by all requests, so the geocode cache and gazetteer are loaded once
+GEOCODER = Geocoder()
+
 
 class EORequest:
     def __init__(self):
@@ -43,6 +46,7 @@ class EORequest:
         self.sub_time_request = False
         self.product_found = None
         self.climate_topics = None
+        self.unresolved_locations = []
 
     
     def post_process_request_variables(self):
@@ -55,20 +59,31 @@ class EORequest:
             
         if self.request_locations[0] not in ["None", None]:
             
-            for location in self.request_locations:
-                try:
-                    adjusted_box, original_box = self._get_coordinates_from_location(
-                        location
-                    )
-                    self.adjusted_bounding_box.append(adjusted_box)
-                    self.original_bounding_box.append(original_box)
-                except Exception as e:  # Specify the exception to catch
-                    # Handle the exception (optional: log the error message)
-                    print(f"Error processing location '{location}': {e}")
-                    self.request_locations = [
-                        "None"
-                    ]  # Setting request_locations to None if any error occurs
-                    break  # Optionally break out of the loop if an error occurs
+            # Locations that miss the geocode cache are looked up concurrently,
+            # the ones that cannot be found are left out of the request
+            results = GEOCODER.resolve_many(self.request_locations)
+            resolved_locations = []
+            
+            for location, (bounding_box, error) in zip(self.request_locations, results):
+                if error is None:
+                    try:
+                        adjusted_box, original_box = self._get_coordinates_from_location(
+                            location, bounding_box=bounding_box
+                        )
+                    except Exception as e:
+                        error = f"invalid bounding box ({e})"
+                
+                if error is not None:
+                    logger.warning(f"Location '{location}' could not be resolved: {error}")
+                    self.unresolved_locations.append(location)
+                    continue
+                
+                resolved_locations.append(location)
+                self.adjusted_bounding_box.append(adjusted_box)
+                self.original_bounding_box.append(original_box)
+            
+            # Setting request_locations to None if no location was found
+            self.request_locations = resolved_locations or ["None"]
 
     def __check_validity_of_request(self):
         self.errors = []
@@ -128,6 +143,33 @@ class EORequest:
         
         return instruction_format
 
+    # identifies the data and analysis the request leads to, requests
+    # with the same hash are processed once by the job manager
+    def request_hash(self):
+        request_description = [
+            [str(location) for location in self.request_locations],
+            self.adjusted_bounding_box,
+            [
+                [
+                    timeframe.startdate_str,
+                    timeframe.enddate_str,
+                    # predictions pin the data window, the horizon changes the forecast
+                    timeframe.prediction_number,
+                    timeframe.prediction_startdate,
+                    timeframe.prediction_enddate,
+                ]
+                for timeframe in self.request_timeframes
+                if isinstance(timeframe, TimeSpan)
+            ],
+            self.variable_short_name,
+            [str(analysis) for analysis in self.request_analysis],
+            self.multi_loc_request,
+            self.multi_time_request,
+        ]
+        return hashlib.sha256(
+            json.dumps(request_description, default=str).encode("utf-8")
+        ).hexdigest()
+
     def load_variables(self):
         return Utilities.load_config_file("yaml/variables.yaml")
 
@@ -186,27 +228,19 @@ class EORequest:
         request.data = request.data.drop_vars(["v10", "u10"])
 
     def _get_coordinates_from_location(
-        self, request_location, min_size: float = 3
+        self, request_location, min_size: float = 3, bounding_box=None
     ) -> dict:
         
         """
-            Get a bounding box for a location using 
-            Google Maps Geocoding API with a minimum size.
+            Get a bounding box for a location with a minimum size, using
+            the geocode cache, the offline gazetteer or Nominatim.
         """
 
-        apikey = "".join(
-            random.choice(
-                string.ascii_letters + 
-                string.digits + 
-                string.punctuation
-            )
-            for _ in range(20)
-        )
-        geolocator = Nominatim(user_agent=apikey)
-        geocode_result = geolocator.geocode(request_location)
+        if bounding_box is None:
+            bounding_box = GEOCODER.resolve(request_location)
 
-        if geocode_result:
-            viewport = geocode_result.raw["boundingbox"]
+        if bounding_box:
+            viewport = bounding_box
             original_bounding_box = {
                 "north": round(float(viewport[0]), 2),
                 "south": round(float(viewport[1]), 2),
@@ -0,0 +1,103 @@
+import json
+import hashlib
+import threading
+import pandas as pd
+
+from collections import OrderedDict
+from loguru import logger
+from utils.utils import apply_timing_decorator
+
+FORECAST_CACHE_MAX_ENTRIES = 64
+
+# Upper bound for the serialized models and forecast frames in memory
+FORECAST_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+# Class for one cached forecast: the fitted Prophet model as JSON, the number
+# of periods it was predicted for and the forecast frame of that horizon
+class CachedForecast():
+    def __init__(self, model_json, periods, forecast):
+        self.model_json = model_json
+        self.periods = periods
+        self.forecast = forecast
+        self.size = len(model_json) + int(forecast.memory_usage(deep=True).sum())
+
+    def forecast_for(self, periods):
+        """
+        Returns:
+            pandas.DataFrame: The forecast cut to the given number of periods,
+            None if it needs a longer horizon than the cached one.
+        """
+        if periods > self.periods:
+            return None
+        return self.forecast.iloc[:len(self.forecast) - (self.periods - periods)].copy()
+
+
+# Class to keep fitted forecast models, keyed by a fingerprint of their
+# training series, so that repeated predictions of the same city and variable
+# skip the Prophet fit. Least recently used entries are evicted by count and size.
+@apply_timing_decorator
+class ForecastCache():
+    def __init__(
+        self,
+        max_entries=FORECAST_CACHE_MAX_ENTRIES,
+        max_bytes=FORECAST_CACHE_MAX_BYTES,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, bounding_box, variable, start_date, end_date, df):
+        """
+        Fingerprint of a training series, from the request it was cut with
+        and a digest of its values (ERA5-Land data may still be revised).
+        """
+        description = json.dumps(
+            [bounding_box, variable, str(start_date), str(end_date)], default=str
+        )
+        series_digest = hashlib.sha256(
+            pd.util.hash_pandas_object(df[["ds", "y"]], index=False).values.tobytes()
+        ).hexdigest()
+        return hashlib.sha256(
+            (description + series_digest).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            cached_forecast = self.entries.get(key)
+            if cached_forecast is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return cached_forecast
+
+    def put(self, key, model_json, periods, forecast):
+        cached_forecast = CachedForecast(model_json, periods, forecast)
+        if cached_forecast.size > self.max_bytes:
+            logger.info(f"Forecast {key[:12]} is too large to be cached")
+            return
+
+        with self._lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key).size
+            self.entries[key] = cached_forecast
+            self.size += cached_forecast.size
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def metrics(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "entries": len(self.entries),
+            "size_bytes": self.size,
+        }
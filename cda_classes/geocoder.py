@@ -0,0 +1,184 @@
+import os
+import csv
+import json
+import time
+import bisect
+import sqlite3
+import threading
+import unicodedata
+
+from geopy.geocoders import Nominatim
+from rapidfuzz import fuzz, process
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from utils.utils import apply_timing_decorator
+
+GEOCODE_CACHE_PATH = "geocode_cache.sqlite"
+GEOCODE_CACHE_TTL_SECONDS = 30 * 24 * 3600
+
+# Optional local extract (e.g. of GeoNames or Natural Earth) with one place per
+# line: name, min_lat, max_lat, min_lon, max_lon, tab separated. Not shipped.
+GAZETTEER_PATH = "assets/gazetteer.tsv"
+GAZETTEER_FUZZY_THRESHOLD = 90
+
+NOMINATIM_USER_AGENT = "climate-data-agent"
+GEOCODE_MAX_CONCURRENT_LOOKUPS = 4
+
+
+def normalize_location(location):
+    # "  New   York " and "new york" share one cache entry
+    location = unicodedata.normalize("NFKC", str(location))
+    return " ".join(location.casefold().split())
+
+
+# Class to persist geocoding results, a bounding box per normalized location
+# name in Nominatim order [min_lat, max_lat, min_lon, max_lon], for ttl seconds
+@apply_timing_decorator
+class GeocodeCache():
+    def __init__(self, cache_path=GEOCODE_CACHE_PATH, ttl_seconds=GEOCODE_CACHE_TTL_SECONDS):
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self._tables_created = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.cache_path)
+        if not self._tables_created:
+            connection.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS locations (
+                        name TEXT PRIMARY KEY,
+                        bounding_box TEXT NOT NULL,
+                        created REAL NOT NULL
+                    )
+                """
+            )
+            self._tables_created = True
+        return connection
+
+    def get(self, location):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT bounding_box, created FROM locations WHERE name = ?",
+                (normalize_location(location),),
+            ).fetchone()
+
+        if row is None or time.time() - row[1] > self.ttl_seconds:
+            return None
+        return json.loads(row[0])
+
+    def put(self, location, bounding_box):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO locations VALUES (?, ?, ?)",
+                (normalize_location(location), json.dumps(bounding_box), time.time()),
+            )
+
+
+# Class to resolve place names from a local gazetteer file without network,
+# by exact, prefix and finally fuzzy match of the normalized name
+@apply_timing_decorator
+class Gazetteer():
+    def __init__(self, gazetteer_path=GAZETTEER_PATH, fuzzy_threshold=GAZETTEER_FUZZY_THRESHOLD):
+        self.fuzzy_threshold = fuzzy_threshold
+        self.places = {}
+        with open(gazetteer_path, newline="", encoding="utf-8") as gazetteer_file:
+            for row in csv.reader(gazetteer_file, delimiter="\t"):
+                if len(row) < 5 or row[0].startswith("#"):
+                    continue
+                # the first entry of a name wins, extracts are sorted by importance
+                self.places.setdefault(
+                    normalize_location(row[0]), [float(value) for value in row[1:5]]
+                )
+        self.names = sorted(self.places)
+        logger.info(f"Loaded {len(self.names)} places from '{gazetteer_path}'")
+
+    def lookup(self, location):
+        name = normalize_location(location)
+        if name in self.places:
+            return self.places[name]
+
+        # "rio de jan" -> "rio de janeiro"
+        idx = bisect.bisect_left(self.names, name)
+        if idx < len(self.names) and self.names[idx].startswith(name):
+            return self.places[self.names[idx]]
+
+        match = process.extractOne(
+            name, self.names, scorer=fuzz.ratio, score_cutoff=self.fuzzy_threshold
+        )
+        if match:
+            return self.places[match[0]]
+        return None
+
+
+# Class to turn location names into bounding boxes: geocode cache first, then
+# the offline gazetteer if one is available, Nominatim only as last resort
+@apply_timing_decorator
+class Geocoder():
+    def __init__(
+        self,
+        cache=None,
+        gazetteer_path=GAZETTEER_PATH,
+        max_concurrent_lookups=GEOCODE_MAX_CONCURRENT_LOOKUPS,
+    ):
+        self.cache = cache or GeocodeCache()
+        self.gazetteer = Gazetteer(gazetteer_path) if os.path.isfile(gazetteer_path) else None
+        self.max_concurrent_lookups = max_concurrent_lookups
+        self._thread_local = threading.local()
+
+    def _get_geolocator(self):
+        if not hasattr(self._thread_local, "geolocator"):
+            self._thread_local.geolocator = Nominatim(user_agent=NOMINATIM_USER_AGENT)
+        return self._thread_local.geolocator
+
+    def resolve(self, location):
+        """
+        Returns:
+            list: [min_lat, max_lat, min_lon, max_lon] of the
+            location or None if it could not be found.
+        """
+        bounding_box = self.cache.get(location)
+        if bounding_box is not None:
+            return bounding_box
+
+        if self.gazetteer is not None:
+            bounding_box = self.gazetteer.lookup(location)
+
+        if bounding_box is None:
+            geocode_result = self._get_geolocator().geocode(location)
+            if not geocode_result:
+                return None
+            bounding_box = [float(value) for value in geocode_result.raw["boundingbox"]]
+
+        self.cache.put(location, bounding_box)
+        return bounding_box
+
+    def resolve_many(self, locations):
+        """
+        Resolve several locations, looking up the cache misses concurrently.
+        A failed lookup does not affect the other locations.
+
+        Returns:
+            list: (bounding_box, error) per location in the order of
+            locations, error is None if the location was found.
+        """
+        results = [(self.cache.get(location), None) for location in locations]
+        missing = [idx for idx, (bounding_box, _) in enumerate(results) if bounding_box is None]
+
+        if len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_concurrent_lookups) as executor:
+                resolved = executor.map(self._try_resolve, [locations[idx] for idx in missing])
+                for idx, result in zip(missing, resolved):
+                    results[idx] = result
+        elif missing:
+            results[missing[0]] = self._try_resolve(locations[missing[0]])
+
+        return results
+
+    def _try_resolve(self, location):
+        try:
+            bounding_box = self.resolve(location)
+        except Exception as e:
+            return None, f"lookup failed ({e})"
+        if bounding_box is None:
+            return None, "no match in the gazetteer or on Nominatim"
+        return bounding_box, None
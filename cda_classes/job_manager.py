@@ -0,0 +1,95 @@
+import time
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from utils.utils import apply_timing_decorator
+
+JOB_MAX_WORKERS = 2
+
+# Results hold the downloaded data and the figures, only
+# the most recently finished jobs are kept in memory
+JOB_MAX_FINISHED = 16
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+# Class for the state of one background job, written by the
+# worker thread and read by the Streamlit sessions polling it
+class Job():
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.status = JOB_QUEUED
+        self.progress = 0.0
+        self.progress_text = ""
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def report_progress(self, finished, total, text=""):
+        self.progress = finished / total if total else 1.0
+        self.progress_text = text
+
+    def is_finished(self):
+        return self.status in [JOB_DONE, JOB_FAILED]
+
+
+# Class to run the data download and analysis of requests on a pool of worker
+# threads, independent of the Streamlit script runs. Jobs are keyed by the hash
+# of their request, so identical requests of different sessions share one job.
+@apply_timing_decorator
+class JobManager():
+    def __init__(self, max_workers=JOB_MAX_WORKERS, max_finished=JOB_MAX_FINISHED):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_finished = max_finished
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, job_id, function, *args):
+        """
+        Run function(job, *args) in the background, unless a job with the
+        same id is in flight or done. Failed jobs are started again.
+
+        Returns:
+            Job: The new or the already existing job.
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.status != JOB_FAILED:
+                self.jobs.move_to_end(job_id)
+                logger.info(f"Job {job_id} is {job.status}, not started again")
+                return job
+
+            job = Job(job_id)
+            self.jobs[job_id] = job
+            self.jobs.move_to_end(job_id)
+
+        self.executor.submit(self._run, job, function, *args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _run(self, job, function, *args):
+        job.status = JOB_RUNNING
+        try:
+            job.result = function(job, *args)
+            job.status = JOB_DONE
+        except Exception as e:
+            logger.exception(f"Job {job.job_id} failed")
+            job.error = e
+            job.status = JOB_FAILED
+        job.finished = time.time()
+        self._evict_finished()
+
+    def _evict_finished(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job.is_finished()]
+            for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self.jobs[job_id]
@@ -1,7 +1,105 @@
+import os
+import copy
+import threading
 import transformers
 import torch
 
-# Class that generates the response on basis of the user and 
+from collections import OrderedDict
+from loguru import logger
+
+# Reuse the key/value cache of the fixed agent instructions across calls,
+# only the prompt of the user at the end of each agent prompt is prefilled
+PREFIX_CACHING = True
+PREFIX_CACHE_MAX_ENTRIES = 16
+
+# Answer agents with a known response_type greedily, starting with the first
+# key of their JSON and stopping at the brace that closes the object
+JSON_CONSTRAINED_DECODING = True
+JSON_MAX_NEW_TOKENS = 256
+
+# Decode every answer greedily, so the same prompt always gives the same
+# answer and cached agent answers are reproducible
+GREEDY_DECODING = True
+
+# "transformers" runs the bfloat16/float16 Hugging Face model, "llama_cpp" a
+# quantized GGUF export of the same model on the CPU (needs llama-cpp-python)
+LLM_BACKEND = "transformers"
+LLAMA_CPP_MODEL_PATH = "models/Meta-Llama-3-8B-Instruct.Q4_K_M.gguf"
+LLAMA_CPP_CONTEXT_SIZE = 4096
+LLAMA_CPP_THREADS = os.cpu_count() or 1
+LLAMA_CPP_PREFIX_CACHE_BYTES = 2 * 1024**3
+
+
+# create the LLM processor of the configured backend
+def load_llm_processor(backend=LLM_BACKEND):
+    if backend == "transformers":
+        return LargeLanguageModelProcessor()
+    elif backend == "llama_cpp":
+        return LlamaCppProcessor()
+    raise ValueError(f"Unsupported LLM backend: {backend}")
+
+
+def json_object_end(text):
+    """
+    Index of the brace that closes the first JSON object in
+    the text, braces inside strings are ignored. -1 if open.
+    """
+    depth = 0
+    in_string = False
+    escaped = False
+    for idx, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return idx
+    return -1
+
+
+# Stops the generation of each sequence once the JSON object of its answer is
+# closed, answer_prefix is one prefix for all or a list with one per sequence
+class JsonObjectStoppingCriteria(transformers.StoppingCriteria):
+    def __init__(self, tokenizer, prompt_length, answer_prefix):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.answer_prefix = answer_prefix
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated_texts = self.tokenizer.batch_decode(
+            input_ids[:, self.prompt_length:], skip_special_tokens=True
+        )
+        answer_prefixes = self.answer_prefix
+        if isinstance(answer_prefixes, str):
+            answer_prefixes = [answer_prefixes] * len(generated_texts)
+        is_done = [
+            json_object_end(answer_prefix + generated_text) != -1
+            for answer_prefix, generated_text in zip(answer_prefixes, generated_texts)
+        ]
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+
+# Stops the generation once the event is set, e.g. when a stream is closed
+class CancelledStoppingCriteria(transformers.StoppingCriteria):
+    def __init__(self, cancelled):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device
+        )
+
+
+# Class that generates the response on basis of the user and
 # agents to collect the parameters for further pipeline
 
 class LargeLanguageModelProcessor():
@@ -15,31 +113,392 @@ class LargeLanguageModelProcessor():
                 "torch_dtype": torch.float16 if torch.cuda.is_available() else torch.bfloat16
                 },
         )
-    def generate_response(self, system_prompt):
+        self.prefix_cache = OrderedDict()
+        # the processor is shared by all sessions and the job threads
+        self._prefix_cache_lock = threading.Lock()
+        self.generated_tokens = 0
+
+    def generate_response(self, system_prompt, static_prefix=None, response_keys=None, sample=False):
         """
         get Response on your input prompt and system prompt
+
+        Args:
+            static_prefix (str): Start of the system prompt that is the same
+                for every call of an agent. Its key/value cache is computed
+                once and only the rest of the prompt is prefilled.
+            response_keys (list): Keys of the JSON the agent answers with.
+                If given, the answer is forced to start with the first key
+                and generation stops at the end of the JSON object.
+            sample (bool): Sample the unconstrained answer even if
+                GREEDY_DECODING is set, e.g. for retries of a failed answer.
         """
 
         messages = [
             {
-                "role": "system", 
+                "role": "system",
                 "content": system_prompt
             }
         ]
+
+        if JSON_CONSTRAINED_DECODING and response_keys:
+            answer_prefix = '{"' + response_keys[0] + '":'
+            response = answer_prefix + self._generate(
+                messages,
+                system_prompt,
+                static_prefix,
+                answer_prefix=answer_prefix,
+                max_new_tokens=JSON_MAX_NEW_TOKENS,
+                do_sample=False,
+            )
+            object_end = json_object_end(response)
+            return response[:object_end + 1] if object_end != -1 else response
+
+        if PREFIX_CACHING and static_prefix:
+            return self._generate(
+                messages,
+                system_prompt,
+                static_prefix,
+                max_new_tokens = 4000,
+                **self._sampling_kwargs(sample),
+            )
+
         # Generate the response
         outputs = self.pipeline(
             messages,
             max_new_tokens = 4000,
-            do_sample = True,
-            temperature = 0.5,
-            top_p=0.95,
+            **self._sampling_kwargs(sample),
         )
 
         # Extract the generated text
         response = outputs[0]["generated_text"][-1]
         text_response = response["content"]
-        
+        self.generated_tokens += len(
+            self.pipeline.tokenizer(text_response, add_special_tokens=False).input_ids
+        )
+
         return text_response
-    
 
+    def stream_response(self, system_prompt, static_prefix=None, response_keys=None):
+        """
+        Like generate_response, but yields the answer in chunks of text
+        as soon as they are decoded. Closing the generator stops the
+        generation.
+        """
+        messages = [
+            {
+                "role": "system",
+                "content": system_prompt
+            }
+        ]
+
+        cancelled = threading.Event()
+        streamer = transformers.TextIteratorStreamer(
+            self.pipeline.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        generation_kwargs = {
+            "streamer": streamer,
+            "stopping_criteria": transformers.StoppingCriteriaList(
+                [CancelledStoppingCriteria(cancelled)]
+            ),
+        }
+
+        answer_prefix = ""
+        if JSON_CONSTRAINED_DECODING and response_keys:
+            answer_prefix = '{"' + response_keys[0] + '":'
+            generation_kwargs.update(max_new_tokens=JSON_MAX_NEW_TOKENS, do_sample=False)
+        else:
+            generation_kwargs.update(max_new_tokens=4000, **self._sampling_kwargs())
+
+        errors = []
+
+        def generate():
+            try:
+                self._generate(
+                    messages,
+                    system_prompt,
+                    static_prefix,
+                    answer_prefix=answer_prefix,
+                    **generation_kwargs,
+                )
+            except Exception as e:
+                errors.append(e)
+                # release the consumer waiting for the next chunk
+                streamer.end()
+
+        generation_thread = threading.Thread(target=generate, daemon=True)
+        generation_thread.start()
+
+        try:
+            response = answer_prefix
+            if answer_prefix:
+                yield answer_prefix
+            for chunk in streamer:
+                if answer_prefix:
+                    object_end = json_object_end(response + chunk)
+                    if object_end != -1:
+                        yield chunk[:object_end + 1 - len(response)]
+                        break
+                response += chunk
+                yield chunk
+        finally:
+            cancelled.set()
+            generation_thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def generate_responses(self, system_prompts, response_keys):
+        """
+        Answer several independent agents with one batched generation.
+
+        Args:
+            system_prompts (list): One system prompt per agent.
+            response_keys (list): The JSON keys of each agent, the batch
+                is only generated together if every agent has keys.
+
+        Returns:
+            list: The responses in the order of the system prompts.
+        """
+        if not (JSON_CONSTRAINED_DECODING and all(response_keys)) or len(system_prompts) < 2:
+            return [
+                self.generate_response(system_prompt, response_keys=keys)
+                for system_prompt, keys in zip(system_prompts, response_keys)
+            ]
+
+        tokenizer = self.pipeline.tokenizer
+        model = self.pipeline.model
+
+        answer_prefixes = ['{"' + keys[0] + '":' for keys in response_keys]
+        prompt_texts = [
+            tokenizer.apply_chat_template(
+                [{"role": "system", "content": system_prompt}],
+                tokenize=False,
+                add_generation_prompt=True,
+            ) + answer_prefix
+            for system_prompt, answer_prefix in zip(system_prompts, answer_prefixes)
+        ]
+
+        # the answers continue right after the prompts, so they are padded on
+        # the left. Padded by hand, the tokenizer is shared with other threads.
+        pad_token_id = (
+            tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        )
+        prompt_ids = tokenizer(prompt_texts, add_special_tokens=False).input_ids
+        prompt_length = max(len(ids) for ids in prompt_ids)
+        input_ids = torch.tensor(
+            [[pad_token_id] * (prompt_length - len(ids)) + ids for ids in prompt_ids],
+            device=model.device,
+        )
+        attention_mask = torch.tensor(
+            [[0] * (prompt_length - len(ids)) + [1] * len(ids) for ids in prompt_ids],
+            device=model.device,
+        )
+
+        output_ids = model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=JSON_MAX_NEW_TOKENS,
+            do_sample=False,
+            pad_token_id=pad_token_id,
+            stopping_criteria=transformers.StoppingCriteriaList(
+                [JsonObjectStoppingCriteria(tokenizer, prompt_length, answer_prefixes)]
+            ),
+        )
+
+        responses = []
+        for answer_prefix, answer_ids in zip(answer_prefixes, output_ids[:, prompt_length:]):
+            self.generated_tokens += int((answer_ids != pad_token_id).sum())
+            response = answer_prefix + tokenizer.decode(answer_ids, skip_special_tokens=True)
+            object_end = json_object_end(response)
+            responses.append(response[:object_end + 1] if object_end != -1 else response)
+        return responses
+
+    def _sampling_kwargs(self, sample=False):
+        if GREEDY_DECODING and not sample:
+            return {"do_sample": False}
+        return {"do_sample": True, "temperature": 0.5, "top_p": 0.95}
+
+    def version(self):
+        """
+        Identifies the model and the decoding settings, answers
+        cached under another version are not reused.
+        """
+        return f"{self.llm}|json={JSON_CONSTRAINED_DECODING}|greedy={GREEDY_DECODING}"
+
+    def _generate(self, messages, system_prompt, static_prefix, answer_prefix="", **generation_kwargs):
+        tokenizer = self.pipeline.tokenizer
+        model = self.pipeline.model
+
+        prompt_text = tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        ) + answer_prefix
+        input_ids = tokenizer(
+            prompt_text, add_special_tokens=False, return_tensors="pt"
+        ).input_ids.to(model.device)
+
+        past_key_values = None
+        if PREFIX_CACHING and static_prefix:
+            prefix_ids = self._static_prefix_ids(prompt_text, system_prompt, static_prefix)
+            if (
+                not prefix_ids
+                or len(prefix_ids) >= input_ids.shape[1]
+                or input_ids[0, :len(prefix_ids)].tolist() != prefix_ids
+            ):
+                logger.warning("Prompt does not start with its static prefix, prefilling all tokens")
+            else:
+                past_key_values = copy.deepcopy(self._get_prefix_cache(tuple(prefix_ids)))
+
+        stopping_criteria = generation_kwargs.pop(
+            "stopping_criteria", transformers.StoppingCriteriaList()
+        )
+        if answer_prefix:
+            stopping_criteria.append(
+                JsonObjectStoppingCriteria(tokenizer, input_ids.shape[1], answer_prefix)
+            )
+
+        output_ids = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            pad_token_id=tokenizer.eos_token_id,
+            stopping_criteria=stopping_criteria,
+            **generation_kwargs,
+        )
+
+        self.generated_tokens += output_ids.shape[1] - input_ids.shape[1]
+        return tokenizer.decode(
+            output_ids[0, input_ids.shape[1]:], skip_special_tokens=True
+        )
+
+    def _static_prefix_ids(self, prompt_text, system_prompt, static_prefix):
+        # the chat template strips the system prompt
+        prefix_end = prompt_text.find(system_prompt.strip())
+        prefix_text = prompt_text[:prefix_end] + static_prefix.lstrip()
+        if prefix_end == -1 or not prompt_text.startswith(prefix_text):
+            return None
+
+        # The last token of the prefix may merge with the text behind it
+        return self.pipeline.tokenizer(prefix_text, add_special_tokens=False).input_ids[:-1]
+
+    def _get_prefix_cache(self, prefix_ids):
+        # held while a missing prefix is prefilled, so it is computed only once
+        with self._prefix_cache_lock:
+            if prefix_ids in self.prefix_cache:
+                self.prefix_cache.move_to_end(prefix_ids)
+                return self.prefix_cache[prefix_ids]
+
+            model = self.pipeline.model
+            with torch.no_grad():
+                outputs = model(
+                    torch.tensor([prefix_ids], device=model.device),
+                    past_key_values=transformers.DynamicCache(),
+                    use_cache=True,
+                )
+            past_key_values = outputs.past_key_values
+            self.prefix_cache[prefix_ids] = past_key_values
+            logger.info(f"Cached the key/values of a {len(prefix_ids)} token prompt prefix")
+
+            if len(self.prefix_cache) > PREFIX_CACHE_MAX_ENTRIES:
+                self.prefix_cache.popitem(last=False)
+            return past_key_values
+
+
+# Class that answers the agents with a quantized GGUF model through llama.cpp,
+# with the same interface as the transformers based processor
+class LlamaCppProcessor():
+    def __init__(self, model_path=LLAMA_CPP_MODEL_PATH):
+        try:
+            from llama_cpp import Llama, LlamaRAMCache
+        except ImportError as e:
+            raise ImportError(
+                "The llama_cpp backend needs the llama-cpp-python package"
+            ) from e
+
+        self.llm = os.path.basename(model_path)
+        self.model = Llama(
+            model_path=model_path,
+            n_ctx=LLAMA_CPP_CONTEXT_SIZE,
+            n_threads=LLAMA_CPP_THREADS,
+            verbose=False,
+        )
+        # keeps the evaluated state of earlier prompts, so the static agent
+        # instructions in front of the user prompt are not evaluated again
+        if PREFIX_CACHING:
+            self.model.set_cache(LlamaRAMCache(capacity_bytes=LLAMA_CPP_PREFIX_CACHE_BYTES))
+        self.generated_tokens = 0
+
+    def generate_response(self, system_prompt, static_prefix=None, response_keys=None, sample=False):
+        """
+        get Response on your input prompt and system prompt
+
+        Args:
+            static_prefix (str): Unused, llama.cpp reuses the
+                longest cached prefix of every prompt by itself.
+            response_keys (list): If given, the answer is decoded with
+                llama.cpp's JSON grammar and at most JSON_MAX_NEW_TOKENS.
+            sample (bool): Sample the unconstrained answer even if
+                GREEDY_DECODING is set.
+        """
+        messages = [
+            {
+                "role": "system",
+                "content": system_prompt
+            }
+        ]
+
+        output = self.model.create_chat_completion(
+            messages=messages, **self._generation_kwargs(response_keys, sample)
+        )
+        self.generated_tokens += output["usage"]["completion_tokens"]
+        return output["choices"][0]["message"]["content"]
+
+    def stream_response(self, system_prompt, static_prefix=None, response_keys=None):
+        """
+        Like generate_response, but yields the answer in chunks of text.
+        Closing the generator stops the generation.
+        """
+        messages = [
+            {
+                "role": "system",
+                "content": system_prompt
+            }
+        ]
+
+        chunks = self.model.create_chat_completion(
+            messages=messages, stream=True, **self._generation_kwargs(response_keys)
+        )
+        try:
+            for chunk in chunks:
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    # llama.cpp streams one token per chunk
+                    self.generated_tokens += 1
+                    yield content
+        finally:
+            chunks.close()
+
+    def _generation_kwargs(self, response_keys, sample=False):
+        generation_kwargs = {"max_tokens": 4000}
+        if GREEDY_DECODING and not sample:
+            generation_kwargs["temperature"] = 0.0
+        else:
+            generation_kwargs.update(temperature=0.5, top_p=0.95)
+
+        if JSON_CONSTRAINED_DECODING and response_keys:
+            generation_kwargs.update(
+                max_tokens=JSON_MAX_NEW_TOKENS,
+                temperature=0.0,
+                response_format={"type": "json_object"},
+            )
+        return generation_kwargs
+
+    def generate_responses(self, system_prompts, response_keys):
+        # llama.cpp evaluates one sequence per context, the agents
+        # are answered one after the other
+        return [
+            self.generate_response(system_prompt, response_keys=keys)
+            for system_prompt, keys in zip(system_prompts, response_keys)
+        ]
 
+    def version(self):
+        return f"{self.llm}|json={JSON_CONSTRAINED_DECODING}|greedy={GREEDY_DECODING}"
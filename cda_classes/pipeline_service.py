@@ -0,0 +1,656 @@
+import gc
+import json
+from datetime import datetime
+
+import regex as re
+import torch
+from loguru import logger
+from rapidfuzz import fuzz, process
+from sentence_transformers import SentenceTransformer, util
+
+from cda_classes.analysis_handler import AnalysisHandler
+from cda_classes.eorequest import EORequest
+from cda_classes.llm_processor import load_llm_processor
+from cda_classes.prompt_manager import PromptManager
+from cda_classes.prototype_classifier import PrototypeClassifier
+from cda_classes.visualisation_handler import VisualisationHandler
+from data_handler.data_handler import DataHandler
+from utils.utils import TimeSpan, Utilities, apply_timing_decorator
+
+DEBUGMODE = False
+
+# Extract location, time ranges, product and analysis type with one LLM call,
+# the single agents are only used if the combined answer cannot be parsed
+COMBINED_EXTRACTION = True
+
+# Answer the agents with small label sets (request type, product, specific
+# product, analysis) by SBERT similarity, the LLM only if that is not confident
+PROTOTYPE_CLASSIFICATION = True
+
+
+# load the LLM, the SBERT model and the label prototypes,
+# the clients keep them for the lifetime of the process
+def load_models():
+    torch.cuda.empty_cache()
+    gc.collect()
+    llm = load_llm_processor()
+    sbert = SentenceTransformer("paraphrase-MiniLM-L6-v2")
+    # the label embeddings are computed once per process
+    prototype_classifier = PrototypeClassifier(sbert) if PROTOTYPE_CLASSIFICATION else None
+    return llm, sbert, prototype_classifier
+
+
+# Raised when a request cannot be processed, the message is meant for the user.
+# Incomplete requests carry the request, a follow up prompt may complete it.
+class RequestRejected(Exception):
+    def __init__(self, message, request=None):
+        super().__init__(message)
+        self.message = message
+        self.request = request
+
+
+# Class that runs the pipeline from the prompt of the user to the data, figures
+# and statistics without any user interface. The streamlit app, the HTTP server
+# and the CLI are clients of it.
+@apply_timing_decorator
+class ClimateDataService():
+    def __init__(self, llm, sbert, prototype_classifier=None):
+        self.sbert = sbert
+        self.prompt_manager = PromptManager(llm, prototype_classifier)
+
+    def prepare_request(self, user_prompt, previous_request=None, on_field=None):
+        """
+        Extract the request from the prompt of the user and check it.
+
+        Args:
+            previous_request (EORequest): The last request of the conversation.
+                If it was incomplete, the prompt is taken as its completion.
+            on_field (callable): Called with each field of the combined
+                extraction as soon as it is generated, see PromptManager.
+
+        Returns:
+            tuple: The valid EORequest and the review message for the user.
+
+        Raises:
+            RequestRejected: If the request cannot be processed.
+        """
+        request = EORequest()
+        request.user_prompt = user_prompt
+
+        if DEBUGMODE:
+            request.populate_dummy_data()
+            return request, ""
+
+        self.check_request(request, user_prompt)
+
+        if previous_request is not None and not previous_request.request_valid:
+            combined_prompt = f"{user_prompt} and {previous_request.user_prompt}"
+            self.extract_information(request, combined_prompt, on_field)
+            user_prompt = combined_prompt
+
+        elif request.request_type[0] == False or request.request_type[0] == "False":
+            raise RequestRejected(
+                """
+                    Thanks for your request.
+                    However there is no climate context.
+                    Please provide more accurate information.
+                """
+            )
+        else:
+            self.extract_information(request, user_prompt, on_field)
+
+        self.check_request_variables(request, user_prompt)
+        return request, self.review_request(request, user_prompt)
+
+    def request_from_fields(self, fields):
+        """
+        Build the request from already extracted fields instead of a prompt.
+
+        Args:
+            fields (dict): "location" (list), "time_ranges" (list of
+                [start, end] in DD/MM/YYYY), "climate_data" (category),
+                "specific_product" (optional) and "analysis_type".
+
+        Returns:
+            tuple: The valid EORequest and the review message for the user.
+
+        Raises:
+            RequestRejected: If the request cannot be processed.
+        """
+        def as_list(value):
+            if value in ["None", None, []]:
+                return ["None"]
+            return value if isinstance(value, list) else [value]
+
+        self.check_fields(fields)
+
+        request = EORequest()
+        request.user_prompt = json.dumps(fields)
+        request.request_type = ["True"]
+        request.request_locations = as_list(fields.get("location"))
+        time_ranges = as_list(fields.get("time_ranges"))
+        if time_ranges == ["None"]:
+            request.request_timeframes = ["None"]
+        else:
+            for time_range in time_ranges:
+                request.process_and_store_timeframe(time_range)
+        request.request_product = as_list(fields.get("climate_data"))
+        request.request_analysis = as_list(fields.get("analysis_type", "basic_analysis"))
+
+        if "specific_product" in fields:
+            request.request_specific_product = as_list(fields["specific_product"])
+            self._finish_extraction(request, None)
+        else:
+            self._finish_extraction(request, " ".join(request.request_product))
+
+        self.check_request_variables(request, " ".join(request.request_product))
+        return request, self.review_request(request, request.user_prompt)
+
+    # checks the shape of the fields of request_from_fields, so malformed
+    # requests are rejected with a message instead of failing further down
+    def check_fields(self, fields):
+        if not isinstance(fields, dict):
+            raise RequestRejected("The request must be a JSON object of fields.")
+
+        time_ranges = fields.get("time_ranges")
+        if time_ranges in ["None", None, []]:
+            return
+        if not isinstance(time_ranges, list):
+            raise RequestRejected("'time_ranges' must be a list of [start, end] dates.")
+        for time_range in time_ranges:
+            if (
+                not isinstance(time_range, list)
+                or len(time_range) != 2
+                or not all(isinstance(date, str) for date in time_range)
+            ):
+                raise RequestRejected(
+                    f"The time range {json.dumps(time_range)} is not a [start, end] pair of dates."
+                )
+            for date in time_range:
+                try:
+                    Utilities.parse_date(date)
+                except ValueError as e:
+                    raise RequestRejected(str(e))
+
+    # Step 0 - check if climate context is provided
+    def check_request(self, request, user_prompt):
+        request.request_type = self.prompt_manager.retrieve_information(
+            "request_type_agent", user_prompt
+        )
+
+    def extract_information(self, request, user_prompt, on_field=None):
+        combined_information = None
+        if COMBINED_EXTRACTION:
+            combined_information = self.prompt_manager.retrieve_combined_information(
+                user_prompt, on_field
+            )
+
+        if combined_information:
+            # Steps 1, 2, 3 and 5 in a single generation
+            request.request_locations = combined_information["location"]
+            if combined_information["time_ranges"] == ["None"]:
+                request.request_timeframes = ["None"]
+            else:
+                for time_range in combined_information["time_ranges"]:
+                    request.process_and_store_timeframe(time_range)
+            request.request_product = combined_information["climate_data"]
+            request.request_analysis = combined_information["analysis_type"]
+        else:
+            self._extract_information_per_agent(request, user_prompt)
+
+        self._finish_extraction(request, user_prompt)
+
+    # the steps that depend on the product and analysis type, the specific
+    # product is only looked up if user_prompt is given
+    def _finish_extraction(self, request, user_prompt):
+        if len(request.request_product) > 1:
+            raise RequestRejected(
+                """
+                    Please note that I can only process one
+                    climate variable at a time. For the best results,
+                    kindly provide a single variable in your request.
+                """
+            )
+
+        # Step 4 - get specific product name
+        if (
+            user_prompt is not None
+            and request.request_product[0] != "None"
+            and request.request_product[0] != None
+        ):
+
+            self.prompt_manager.specific_product_list = (
+                request.construct_product_agent_instruction()
+            )
+            self.prompt_manager.specific_product_category = request.request_product[0]
+            request.request_specific_product = (
+                self.prompt_manager.retrieve_information(
+                    "specific_product_agent", user_prompt
+                )
+            )
+
+        # Step 5.1 - if one location and comparison is detected then try to find the two different time ranges
+        if request.request_analysis[0] == "comparison":
+            request.multi_loc_request = True
+
+            if len(request.request_locations) == 1:
+                request.multi_time_request = True
+                request.multi_loc_request = False
+
+        request.post_process_request_variables()
+
+    # fallback with one agent call per parameter, the agents that do not
+    # depend on each other are answered together
+    def _extract_information_per_agent(self, request, user_prompt):
+
+        # Steps 1, 2, 3 and 5 - get location, time context, product type and analysis type
+        (
+            request.request_locations,
+            time_contexts,
+            request.request_product,
+            request.request_analysis,
+        ) = self.prompt_manager.retrieve_information_many(
+            [
+                ("location_agent", user_prompt),
+                ("time_context_extractor_agent", user_prompt),
+                ("product_agent", user_prompt),
+                ("analysis_agent", user_prompt),
+            ]
+        )
+        request.request_locations = self.search_and_check_all_loc(
+            request.request_locations, user_prompt
+        )
+
+        # Step 2 - get time interval of each time context
+        if any(context is None or context == "None" for context in time_contexts):
+
+            # If there is None or 'None' in the list, create a new list with one entry and return it
+            request.request_timeframes = [
+                "None"
+            ]  # Replace 'default_time_entry' with your desired entry
+        else:
+            time_ranges = self.prompt_manager.retrieve_information_many(
+                [
+                    ("time_range_extraction_agent", time_context)
+                    for time_context in time_contexts
+                ]
+            )
+            for time_range in time_ranges:
+                request.process_and_store_timeframe(time_range)
+
+    # validate the extracted variables, look up the product and check the
+    # analysis type against the time frame
+    def check_request_variables(self, request, user_prompt):
+        request.process_request()
+        # If the product was not found, tell the user
+        if (
+            request.product_found == False
+            and request.request_product[0] != "None"
+        ):
+            request.load_variable_topics_list()
+            # Create a formatted message with bullet points
+            bullet_points = "\n".join(
+                f"- {climate_topic}"
+                for climate_topic in request.climate_topics
+            )  # Join with newline for bullet points
+            requested_product_in_query = self._detect_similar_product_in_user_query(
+                user_prompt, request.request_product[0]
+            )
+            raise RequestRejected(
+                f"""
+                    The requested product '{requested_product_in_query}' was not found.
+                    Please provide a valid variable from the collection:\n{bullet_points}
+                """
+            )
+
+        self.analysis_compatability(request)
+
+        if not request.request_valid:
+            self.prompt_manager.callback_assistant_to_user(
+                "missing_info_agent", user_prompt, request.errors
+            )
+            raise RequestRejected(self.prompt_manager.callback, request)
+
+    # summary of the valid request for the user
+    def review_request(self, request, user_prompt):
+        self.prompt_manager.callback_assistant_to_user(
+            "review_agent", user_prompt, request
+        )
+        if request.unresolved_locations:
+            return (
+                f"{self.prompt_manager.callback}\n\n"
+                f"Note: {Utilities.join_locations(request.unresolved_locations)} "
+                f"could not be found and {'is' if len(request.unresolved_locations) == 1 else 'are'} "
+                f"left out of the request."
+            )
+        return self.prompt_manager.callback
+
+    def run_request(self, request, progress_callback=None):
+        """
+        Data download, data processing, visualisation and analysis
+        of a prepared request.
+
+        Args:
+            progress_callback (callable): Called with the number of
+                finished and of all data requests of the download.
+
+        Returns:
+            dict: The request, the animation, the analysis figures
+            and texts, the tab names and the header of the analysis.
+        """
+        animation = None
+        if not DEBUGMODE:
+            request.collect_eorequests()
+
+            # own data handler per run, it keeps the state of its request
+            DataHandler().download(request, progress_callback=progress_callback)
+            request.store_and_process_data()
+            animation = VisualisationHandler().visualise_data(request)
+
+        figures = None
+        analysis_texts = None
+        analysis_handler = AnalysisHandler()
+        analysis_type = request.request_analysis[0]
+        if isinstance(analysis_type, str) and not (
+            analysis_type == None or analysis_type == ""
+        ):
+            match (analysis_type):
+                case "basic_analysis":
+                    figures, analysis_texts = analysis_handler.basic_analysis(request)
+
+                case "comparison":
+                    figures, analysis_texts = analysis_handler.comparison(request)
+
+                case "predictions":
+                    figures, analysis_texts = analysis_handler.predictions(request)
+
+                case "significant_event_detection":
+                    figures, analysis_texts = (
+                        analysis_handler.significant_event_detection(request)
+                    )
+
+                case _:
+                    logger.error(
+                        "Unexpected type of analysis provided! Received:"
+                        + analysis_type
+                    )
+
+        else:
+            logger.info("No analysis type was present.")
+
+        tab_names, analysis_header = None, None
+        if figures is not None:
+            tab_names, analysis_header = self.create_tab_names(request, len(figures))
+
+        return {
+            "request": request,
+            "animation": animation,
+            "figures": figures,
+            "analysis_texts": analysis_texts,
+            "tab_names": tab_names,
+            "analysis_header": analysis_header,
+        }
+
+    # run_request as job of the JobManager, which reports the download progress
+    def run_request_job(self, job, request):
+        return self.run_request(
+            request,
+            progress_callback=lambda finished, total: job.report_progress(
+                finished,
+                total,
+                f"Downloaded {finished} of {total} data requests",
+            ),
+        )
+
+    def result_to_json(self, result):
+        """
+        Returns:
+            dict: JSON serializable summary of the request and its analysis,
+            the figures as plotly JSON.
+        """
+        request = result["request"]
+        timeframes = [
+            [timeframe.startdate_str, timeframe.enddate_str]
+            for timeframe in request.request_timeframes
+            if isinstance(timeframe, TimeSpan)
+        ]
+        return {
+            "request": {
+                "locations": request.request_locations,
+                "time_ranges": timeframes,
+                "product": request.request_product[0],
+                "variable": request.variable_long_name,
+                "units": request.variable_units,
+                "analysis_type": request.request_analysis[0],
+            },
+            "analysis_header": result["analysis_header"],
+            "tabs": result["tab_names"],
+            "analysis_texts": result["analysis_texts"],
+            "figures": [
+                json.loads(figure.to_json()) if figure else None
+                for figure in result["figures"] or []
+            ],
+        }
+
+    # checks if the user is using wrong analysis types regarding to the timeframe
+    # For Example: User says Prediction for the past -> contradiction causes user callback
+    def analysis_compatability(self, request):
+        cutoff_year_past = 1950  # Define the cutoff year as 1950
+        # Define the cutoff date as July 1, 2024
+        cutoff_date_present = datetime(2024, 8, 1)
+
+        if request.request_timeframes[0] != "None":
+            for timeframe in request.request_timeframes:
+                # Check for basic_analysis or comparison
+                if (
+                    request.request_analysis[0] == "basic_analysis"
+                    or request.request_analysis[0] == "comparison"
+                ):
+                    if (
+                        timeframe.startdate.year >= cutoff_date_present.year
+                        or timeframe.enddate.year >= cutoff_date_present.year
+                    ):
+                        raise RequestRejected(
+                            f"""
+                                The {request.request_analysis[0]}
+                                cannot be shown for the current date
+                                and beyond (after 2024).
+                                Please try another time frame.
+                                """
+                        )
+                    # Check if the timeframe includes years earlier than 1950
+                    elif (
+                        timeframe.startdate.year < cutoff_year_past
+                        or timeframe.enddate.year < cutoff_year_past
+                    ):
+                        raise RequestRejected(
+                            f"""
+                                The {request.request_analysis[0]}
+                                cannot be shown for years before 1950.
+                                Please try another timeframe.
+                                """
+                        )
+
+                # Check for predictions
+                elif request.request_analysis[0] == "predictions":
+                    if (
+                        timeframe.prediction_startdate.year < cutoff_date_present.year
+                        or timeframe.prediction_enddate.year < cutoff_date_present.year
+                    ):
+                        raise RequestRejected(
+                            f"""
+                                The {request.request_analysis[0]}
+                                cannot be shown for previous years before 2024.
+                                Please try a timeframe towards the future!
+                            """
+                        )
+
+    # Algorithm to delete found location and 
+    # check for another location in prompt
+    def search_and_check_all_loc(self, locations, user_prompt):
+        threshold = 70  # Define your threshold for fuzzy matching
+
+        # Loop until no location is found
+        while locations and locations[0] not in ["None", None]:
+            # Convert found locations to lowercase for case-insensitive comparison
+            found_locations_lower = [loc.lower() for loc in locations]
+
+            # Split the user prompt into words and convert to lowercase
+            words_in_prompt = [word.lower() for word in user_prompt.split()]
+
+            # Track matches to remove from the prompt
+            matches_to_remove = []
+
+            # Fuzzy matching to find best matches for found locations
+            for loc in found_locations_lower:
+                match, score, _ = process.extractOne(loc, words_in_prompt, scorer=fuzz.token_sort_ratio)
+                if score >= threshold:
+                    matches_to_remove.append(loc)
+                    print(f"Match: {loc} with score: {score}")
+
+            # Clean the user prompt based on found matches
+            cleaned_prompt = user_prompt
+            for match in matches_to_remove:
+                # Remove matched terms from cleaned_prompt
+                cleaned_prompt = re.sub(
+                    r"\b" + re.escape(match) + r"\b[,\s!?.]*",
+                    "",
+                    cleaned_prompt,
+                    flags=re.IGNORECASE,
+                )
+
+            # Handle leftover punctuation and whitespace
+            cleaned_prompt = re.sub(r"\band\b[,\s]*", "", cleaned_prompt, flags=re.IGNORECASE)
+            cleaned_prompt = re.sub(r"\s*,\s*", ", ", cleaned_prompt)  # Normalize commas
+            cleaned_prompt = re.sub(r",\s*$", "", cleaned_prompt)  # Remove trailing commas
+            cleaned_prompt = re.sub(r"\s+", " ", cleaned_prompt)  # Remove extra spaces
+            cleaned_prompt = cleaned_prompt.strip()  # Trim whitespace
+
+            print("Cleaned Prompt:", cleaned_prompt)
+
+            # Retrieve new locations from the cleaned prompt
+            found_location = self.prompt_manager.retrieve_information("location_agent", cleaned_prompt)
+            
+            if found_location:  # Ensure found_location is not empty
+                is_location = self.prompt_manager.retrieve_information("binary_location_detection", found_location[0])
+
+                if is_location[0] == "False":
+                    return locations  # Exit if no valid location is found
+                else:
+                    # Check if the new found location is not already in the existing found locations
+                    if found_location[0].lower() not in found_locations_lower:
+                        locations.append(found_location[0])  # Add new location
+
+        return locations  # Return updated locations list
+
+    # Create Tab names for the request to split it up into different subrequest e.g. multiple locations
+    def create_tab_names(self, request, len_figures):
+        if request.request_analysis[0] == "basic_analysis":
+            tab_names = []
+            for sub_request in request.collected_sub_requests:
+                if (
+                    sub_request.timeframe_object.startdate.year
+                    != sub_request.timeframe_object.enddate.year
+                ):
+                    tab_name = (
+                        f"{sub_request.location} {sub_request.timeframe_object.startdate.year}-"
+                        f"{sub_request.timeframe_object.enddate.year}"
+                    )
+
+                else:
+                    tab_name = (
+                        f"{sub_request.location} "
+                        f"{sub_request.timeframe_object.startdate.year}"
+                    )
+                tab_names.append(tab_name)
+            analysis_header = "Basic Analysis"
+            return tab_names, analysis_header
+
+        elif request.request_analysis[0] == "predictions":
+            tab_names = [
+                (
+                    f"{request.collected_sub_requests[i].location} "
+                    f"{request.collected_sub_requests[i].timeframe_object.prediction_startdate.year}-"
+                    f"{request.collected_sub_requests[i].timeframe_object.prediction_enddate.year}"
+                )
+                for i in range(len_figures)
+            ]
+            analysis_header = "Prediction"
+            return tab_names, analysis_header
+
+        elif (
+            request.request_analysis[0] == "comparison"
+            and request.multi_loc_request
+        ):
+            # Concatenate location names and date ranges into a single tab
+            locations = " vs. ".join(
+                [
+                    sub_request.location
+                    for sub_request in request.collected_sub_requests
+                ]
+            )
+            if (
+                request.collected_sub_requests[0].timeframe_object.startdate.year
+                != request.collected_sub_requests[0].timeframe_object.enddate.year
+            ):
+                date_ranges = (
+                        f"{request.collected_sub_requests[0].timeframe_object.startdate.year}-"
+                        f"{request.collected_sub_requests[0].timeframe_object.enddate.year}"
+                )
+                
+            else:
+                date_ranges = (
+                        f"{request.collected_sub_requests[0].timeframe_object.startdate.year}"
+                )
+                
+            tab_names = [f"{locations} in {date_ranges}"]
+            analysis_header = "Comparison over Location"
+            
+            return tab_names, analysis_header
+        
+        elif (
+            request.request_analysis[0] == "comparison"
+            and request.multi_time_request
+        ):
+            # Concatenate timeframes into a single tab 
+            # (assuming the same location for multiple timeframes)
+            location = request.collected_sub_requests[0].location
+            date_ranges = []  # To accumulate the formatted date ranges
+
+            for sub_request in request.collected_sub_requests:
+                if (
+                    sub_request.timeframe_object.startdate.year
+                    != sub_request.timeframe_object.enddate.year
+                ):
+                    date_range = (
+                        f"""
+                        {sub_request.timeframe_object.startdate.year}-
+                        {sub_request.timeframe_object.enddate.year}
+                        """
+                    )
+                else:
+                    date_range = f"{sub_request.timeframe_object.startdate.year}"
+
+                date_ranges.append(date_range)  # Add the formatted range to the list
+
+            # Concatenate the date ranges with ' vs. ' to show comparison
+            concatenated_date_ranges = " vs. ".join(date_ranges)
+            
+            tab_names = [f"{location} {concatenated_date_ranges}"]
+            analysis_header = "Comparison over Time"
+            return tab_names, analysis_header
+
+    def _detect_similar_product_in_user_query(self, user_prompt, product):
+        # Load a lightweight SBERT model
+
+        # Get embeddings for the sentence tokens
+        sentence_embeddings = self.sbert.encode(user_prompt.split())
+        target_embedding = self.sbert.encode([product])
+
+        # Compute cosine similarity between the target word and sentence words
+        similarities = util.cos_sim(target_embedding, sentence_embeddings)
+        print(
+            f"Most similar word to '{product}' is: {user_prompt.split()[similarities.argmax()]}"
+        )
+
+        return user_prompt.split()[similarities.argmax()]
@@ -1,49 +1,141 @@
+import re
+import json
 import string
 
 from cda_classes.llm_processor import LargeLanguageModelProcessor
 from cda_classes.analysis_handler import AnalysisHandler
 from cda_classes.eorequest import EORequest
+from cda_classes.response_cache import AgentResponseCache, normalize_prompt
 from datetime import datetime
 from utils.utils import Utilities
 from loguru import logger
 
+# Shared by all sessions, so repeated prompts are answered without the LLM
+AGENT_RESPONSE_CACHE = AgentResponseCache()
+
+
+# Class to parse a JSON answer while it is generated, every field of
+# the top level object is returned once its value is complete
+class PartialJsonParser():
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self._position = 0
+        self._object_start = -1
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._closed = False
+    
+    def feed(self, chunk):
+        """
+        Returns:
+            list: (field, value) pairs completed by the chunk.
+        """
+        self.text += chunk
+        completed = []
+        
+        while self._position < len(self.text) and not self._closed:
+            char = self.text[self._position]
+            if self._object_start == -1:
+                # text in front of the object
+                if char == "{":
+                    self._object_start = self._position
+                    self._depth = 1
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "]}":
+                self._depth -= 1
+                if self._depth == 0:
+                    completed += self._parse_fields(self.text[self._object_start:self._position])
+                    self._closed = True
+            elif char == "," and self._depth == 1:
+                completed += self._parse_fields(self.text[self._object_start:self._position])
+            self._position += 1
+        
+        return completed
+    
+    def _parse_fields(self, object_text):
+        # the fields in front of the position form a complete object
+        try:
+            fields = json.loads(object_text + "}")
+        except json.JSONDecodeError:
+            try:
+                fields = json.loads(object_text.replace("'", '"') + "}")
+            except json.JSONDecodeError:
+                return []
+        
+        completed = [
+            (field, value) for field, value in fields.items() if field not in self.fields
+        ]
+        self.fields.update(completed)
+        return completed
+
 # Class for the creation of system prompts for the agents 
 # to get the parameters that needed to extract
 
 class PromptManager():
-    def __init__(self, llm_handler: LargeLanguageModelProcessor):
+    def __init__(self, llm_handler: LargeLanguageModelProcessor, prototype_classifier=None):
         self.llm_handler = llm_handler
+        self.prototype_classifier = prototype_classifier
         self.__load_agents()
         self.specific_product_list = None
+        self.specific_product_category = None
         self.request = None
         self.analysis_handler = AnalysisHandler()
         
     # function to build the specialized agent on basis of 
     # pre build system prompts and user prompts that get concatenated
     def retrieve_information(self, agent_type, user_prompt):
+        user_prompt = normalize_prompt(user_prompt)
+        
+        # closed label sets are answered by embedding similarity if it is confident
+        if self.prototype_classifier is not None:
+            information = self.prototype_classifier.classify(
+                agent_type, user_prompt, self.specific_product_category
+            )
+            if information is not None:
+                return information
+        
         system_prompt = self.construct_system_prompt(agent_type, user_prompt)
+        
+        # The system prompt holds everything the answer depends on
+        cached_information = AGENT_RESPONSE_CACHE.get(
+            agent_type, system_prompt, self.llm_handler.version()
+        )
+        if cached_information is not None:
+            logger.info(f"Cached answer of {agent_type}: {cached_information}")
+            return cached_information
+        
+        static_prefix = self.static_prompt_prefix(system_prompt, user_prompt)
         max_retries = 5
         
         for attempt in range(max_retries):
             try:
-                # Try to generate a response using the LLM handler
-                information = self.llm_handler.generate_response(system_prompt)
+                # Try to generate a response using the LLM handler, the
+                # first attempt is constrained to the JSON of the agent. A
+                # greedy retry would repeat the same answer, later retries sample.
+                information = self.llm_handler.generate_response(
+                    system_prompt, 
+                    static_prefix, 
+                    self.response_keys(agent_type) if attempt == 0 else None,
+                    sample=attempt > 1,
+                )
                 logger.info(f"Extracted the following information from user prompt: {information}")
+                flattened_values = self._flatten_information(information)
                 
-                # Clean the extracted information
-                cleaned_information = Utilities.cleaned_dict_output(information)
-                
-                # Extract values from the cleaned information
-                dict_values = list(cleaned_information.values())
-                
-                # Flatten the values if necessary
-                flattened_values = []
-                for value in dict_values:
-                    if isinstance(value, list):
-                        flattened_values.extend(value)  # Add items from the list
-                    else:
-                        flattened_values.append(value)  # Add single value
-                
+                AGENT_RESPONSE_CACHE.put(
+                    agent_type, system_prompt, self.llm_handler.version(), flattened_values
+                )
                 # Return the flattened values
                 return flattened_values
             
@@ -55,6 +147,194 @@ class PromptManager():
                     logger.error("Max retries reached. Unable to retrieve information.")
                     return {"error": "Unable to retrieve information after multiple attempts."}  # Return an error after retries
 
+    # answer several independent agents together, a list of (agent_type, user_prompt)
+    # pairs gives the answers in the same order. The agents that are neither answered
+    # by the prototype classifier nor by the cache are generated as one batch, failed
+    # answers are retried one by one.
+    def retrieve_information_many(self, agent_requests):
+        answers = [None] * len(agent_requests)
+        pending = []
+        
+        for idx, (agent_type, user_prompt) in enumerate(agent_requests):
+            user_prompt = normalize_prompt(user_prompt)
+            if self.prototype_classifier is not None:
+                answers[idx] = self.prototype_classifier.classify(
+                    agent_type, user_prompt, self.specific_product_category
+                )
+                if answers[idx] is not None:
+                    continue
+            
+            system_prompt = self.construct_system_prompt(agent_type, user_prompt)
+            answers[idx] = AGENT_RESPONSE_CACHE.get(
+                agent_type, system_prompt, self.llm_handler.version()
+            )
+            if answers[idx] is None:
+                pending.append((idx, agent_type, user_prompt, system_prompt))
+        
+        if not pending:
+            return answers
+        
+        responses = self.llm_handler.generate_responses(
+            [system_prompt for _, _, _, system_prompt in pending],
+            [self.response_keys(agent_type) for _, agent_type, _, _ in pending],
+        )
+        
+        for (idx, agent_type, user_prompt, system_prompt), information in zip(pending, responses):
+            logger.info(f"Extracted the following information from user prompt: {information}")
+            try:
+                answers[idx] = self._flatten_information(information)
+            except Exception as e:
+                logger.error(f"Batched answer of {agent_type} failed with error: {e}")
+                answers[idx] = self.retrieve_information(agent_type, user_prompt)
+                continue
+            
+            AGENT_RESPONSE_CACHE.put(
+                agent_type, system_prompt, self.llm_handler.version(), answers[idx]
+            )
+        
+        return answers
+    
+    def _flatten_information(self, information):
+        # Clean the extracted information
+        cleaned_information = Utilities.cleaned_dict_output(information)
+        
+        # Extract values from the cleaned information
+        dict_values = list(cleaned_information.values())
+        
+        # Flatten the values if necessary
+        flattened_values = []
+        for value in dict_values:
+            if isinstance(value, list):
+                flattened_values.extend(value)  # Add items from the list
+            else:
+                flattened_values.append(value)  # Add single value
+        
+        return flattened_values
+
+    # extract all independent parameters of a request with one generation,
+    # returns None so that the caller can fall back to the single agents.
+    # on_field(field, value) is called as soon as a field of the answer is
+    # generated, if it returns False the generation is cancelled and the
+    # fields that are still missing are set to 'None'.
+    def retrieve_combined_information(self, user_prompt, on_field=None):
+        user_prompt = normalize_prompt(user_prompt)
+        try:
+            system_prompt = self.construct_system_prompt(
+                "combined_extraction_agent", user_prompt
+            )
+        except (KeyError, ValueError, IndexError) as e:
+            logger.error(f"Could not build the combined extraction prompt: {e}")
+            return None
+        
+        cached_information = AGENT_RESPONSE_CACHE.get(
+            "combined_extraction_agent", system_prompt, self.llm_handler.version()
+        )
+        if cached_information is not None:
+            logger.info(f"Cached answer of combined_extraction_agent: {cached_information}")
+            if on_field is not None:
+                for field, value in cached_information.items():
+                    on_field(field, value)
+            return cached_information
+        
+        static_prefix = self.static_prompt_prefix(system_prompt, user_prompt)
+        response_keys = self.response_keys("combined_extraction_agent")
+        max_retries = 2
+        
+        for attempt in range(max_retries):
+            try:
+                if on_field is None:
+                    information = self.llm_handler.generate_response(
+                        system_prompt, 
+                        static_prefix, 
+                        response_keys if attempt == 0 else None,
+                    )
+                else:
+                    information, streamed_fields = self._stream_information(
+                        system_prompt, 
+                        static_prefix, 
+                        response_keys if attempt == 0 else None,
+                        on_field,
+                    )
+                    if information is None:
+                        logger.info(f"Combined extraction cancelled after the fields {streamed_fields}")
+                        # not cached, the answer is incomplete
+                        return self._validate_combined_information(
+                            {key: streamed_fields.get(key, "None") for key in response_keys}
+                        )
+                logger.info(f"Extracted the following information from user prompt: {information}")
+                
+                cleaned_information = Utilities.cleaned_dict_output(information)
+                combined_information = self._validate_combined_information(cleaned_information)
+                AGENT_RESPONSE_CACHE.put(
+                    "combined_extraction_agent", 
+                    system_prompt, 
+                    self.llm_handler.version(), 
+                    combined_information,
+                )
+                return combined_information
+            
+            except Exception as e:
+                logger.error(f"Combined extraction attempt {attempt + 1} failed with error: {e}")
+        
+        logger.error("Combined extraction failed, falling back to the single agents.")
+        return None
+    
+    def _stream_information(self, system_prompt, static_prefix, response_keys, on_field):
+        """
+        Returns:
+            tuple: The generated answer and the streamed fields,
+            the answer is None if on_field cancelled the generation.
+        """
+        parser = PartialJsonParser()
+        chunks = self.llm_handler.stream_response(system_prompt, static_prefix, response_keys)
+        try:
+            for chunk in chunks:
+                for field, value in parser.feed(chunk):
+                    if on_field(field, value) is False:
+                        return None, parser.fields
+        finally:
+            chunks.close()
+        
+        return parser.text, parser.fields
+    
+    def _validate_combined_information(self, information):
+        """
+        Bring the combined answer into the format of the single agents
+        and raise if a field is missing or a date is malformed.
+        """
+        def as_list(value):
+            if value in ["None", None, []]:
+                return ["None"]
+            return value if isinstance(value, list) else [value]
+        
+        time_ranges = as_list(information["time_ranges"])
+        if time_ranges != ["None"]:
+            for time_range in time_ranges:
+                if len(time_range) != 2:
+                    raise ValueError(f"Time range '{time_range}' needs a start and an end date")
+                for date in time_range:
+                    datetime.strptime(date, "%d/%m/%Y")
+        
+        return {
+            "location": as_list(information["location"]),
+            "time_ranges": time_ranges,
+            "climate_data": as_list(information["climate_data"]),
+            "analysis_type": as_list(information["analysis_type"]),
+        }
+
+    # keys of the JSON an agent answers with, taken from its response_type
+    def response_keys(self, agent_type):
+        response_type = self.__agents['attributes'][agent_type]["response_type"] or ""
+        return re.findall(r'"(\w+)"\s*:', response_type)
+
+    # the instructions in front of the prompt of the user are the same for
+    # every call of an agent, the LLM processor caches their key/values
+    def static_prompt_prefix(self, system_prompt, user_prompt):
+        prompt_start = system_prompt.rfind(f"'{user_prompt}.'")
+        if prompt_start == -1:
+            return None
+        return system_prompt[:prompt_start]
+
     # create callback to the user either 
     # to inform for missing information or for correct request
     def callback_assistant_to_user(
@@ -159,6 +439,13 @@ class PromptManager():
             system_prompt = temp_prompt.safe_substitute(
                 {'analysis_types' : self.analysis_handler.analysis_types})
             
+        elif agent_type == "combined_extraction_agent":
+            
+            temp_prompt = string.Template(system_prompt)
+            system_prompt = temp_prompt.safe_substitute(
+                {'analysis_types' : self.analysis_handler.analysis_types})
+            system_prompt = system_prompt.format(current_date = datetime.now().strftime('%Y'))
+            
         elif agent_type == "missing_info_agent":
             
             formatted_string = '\n'.join(f"- {item.replace('request_', '').capitalize()}" for item in self.request)
@@ -0,0 +1,125 @@
+from loguru import logger
+from sentence_transformers import util
+from utils.utils import Utilities, apply_timing_decorator
+
+# A label is only taken if its most similar prototype reaches the threshold and
+# beats the best prototype of every other label by the margin, else the LLM
+# agent answers. It also answers if several labels reach the threshold, e.g.
+# a prompt about two products that has to be rejected.
+PROTOTYPE_CONFIDENCE_THRESHOLD = 0.6
+PROTOTYPE_CONFIDENCE_MARGIN = 0.1
+
+# agents whose labels name a single word or short term of the prompt, for them
+# also the words and word pairs of the prompt are compared to the prototypes
+SPAN_MATCHED_AGENTS = ["product_agent", "specific_product_agent"]
+
+
+# Class to answer the agents that choose from a small closed set of labels
+# without the LLM, by the nearest SBERT embedding of precomputed label prototypes
+@apply_timing_decorator
+class PrototypeClassifier():
+    def __init__(
+        self,
+        sbert,
+        threshold=PROTOTYPE_CONFIDENCE_THRESHOLD,
+        margin=PROTOTYPE_CONFIDENCE_MARGIN,
+    ):
+        self.sbert = sbert
+        self.threshold = threshold
+        self.margin = margin
+
+        agents = Utilities.load_config_file("yaml/agents.yaml")["attributes"]
+        variables = Utilities.load_config_file("yaml/variables.yaml")
+
+        # only the categories the product agent may answer with
+        product_categories = [
+            category for category in variables
+            if category in agents["product_agent"]["list_of_types"]
+        ]
+
+        # label sets per agent, the specific products per product category
+        self.prototypes = {
+            "request_type_agent": self._embed(agents["request_type_agent"]["prototypes"]),
+            "analysis_agent": self._embed(agents["analysis_agent"]["prototypes"]),
+            "product_agent": self._embed(
+                {
+                    category: [category] + [
+                        text
+                        for product in products
+                        for text in (product["name"], product["description"])
+                    ]
+                    for category, products in variables.items()
+                    if category in product_categories
+                }
+            ),
+        }
+        self.specific_product_prototypes = {
+            category: self._embed(
+                {
+                    product["name"]: [product["name"], product["description"]]
+                    for product in products
+                }
+            )
+            for category, products in variables.items()
+        }
+
+    def _embed(self, prototypes):
+        labels = []
+        texts = []
+        for label, label_texts in prototypes.items():
+            labels.extend([str(label)] * len(label_texts))
+            texts.extend(label_texts)
+        return labels, self.sbert.encode(texts, convert_to_tensor=True)
+
+    def classify(self, agent_type, user_prompt, product_category=None):
+        """
+        Args:
+            product_category (str): Category of the request, needed
+                for the specific_product_agent.
+
+        Returns:
+            list: The answer in the format of the LLM agent, e.g.
+            ["Temperature"], or None if the classifier is not confident.
+        """
+        if agent_type == "specific_product_agent":
+            if product_category not in self.specific_product_prototypes:
+                return None
+            labels, embeddings = self.specific_product_prototypes[product_category]
+            # nothing to choose from
+            if len(set(labels)) == 1:
+                return [labels[0]]
+        elif agent_type in self.prototypes:
+            labels, embeddings = self.prototypes[agent_type]
+        else:
+            return None
+
+        queries = [user_prompt]
+        if agent_type in SPAN_MATCHED_AGENTS:
+            words = user_prompt.split()
+            queries += words + [" ".join(pair) for pair in zip(words, words[1:])]
+
+        similarities = util.cos_sim(
+            self.sbert.encode(queries, convert_to_tensor=True), embeddings
+        ).max(dim=0).values
+
+        label_scores = {}
+        for label, similarity in zip(labels, similarities.tolist()):
+            label_scores[label] = max(similarity, label_scores.get(label, -1.0))
+
+        ranked = sorted(label_scores.items(), key=lambda item: item[1], reverse=True)
+        best_label, best_score = ranked[0]
+        runner_up_score = ranked[1][1] if len(ranked) > 1 else -1.0
+
+        if (
+            best_score < self.threshold
+            or runner_up_score >= self.threshold
+            or best_score - runner_up_score < self.margin
+        ):
+            logger.info(
+                f"{agent_type} not answered by prototypes, "
+                f"best '{best_label}' with {best_score:.2f}"
+            )
+            return None
+
+        logger.info(f"{agent_type} answered by prototypes: '{best_label}' with {best_score:.2f}")
+        return [best_label]
@@ -0,0 +1,107 @@
+import copy
+import json
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+
+from collections import OrderedDict
+from utils.utils import apply_timing_decorator
+
+AGENT_RESPONSE_CACHE_MAX_ENTRIES = 1024
+
+# Set to a file (e.g. "agent_response_cache.sqlite") to keep the
+# answers across restarts, None keeps them in memory only
+AGENT_RESPONSE_CACHE_PATH = None
+
+
+def normalize_prompt(prompt):
+    prompt = unicodedata.normalize("NFKC", str(prompt))
+    return " ".join(prompt.split())
+
+
+# Class to memoize the parsed answers of the agents, keyed by agent type,
+# normalized prompt and a version hash of the model and decoding settings
+@apply_timing_decorator
+class AgentResponseCache():
+    def __init__(
+        self,
+        max_entries=AGENT_RESPONSE_CACHE_MAX_ENTRIES,
+        cache_path=AGENT_RESPONSE_CACHE_PATH,
+    ):
+        self.max_entries = max_entries
+        self.cache_path = cache_path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if self.cache_path:
+            with self._connect() as connection:
+                connection.execute(
+                    """
+                        CREATE TABLE IF NOT EXISTS responses (
+                            key TEXT PRIMARY KEY,
+                            response TEXT NOT NULL
+                        )
+                    """
+                )
+
+    def _connect(self):
+        return sqlite3.connect(self.cache_path)
+
+    def key(self, agent_type, prompt, version):
+        serialized = json.dumps([agent_type, normalize_prompt(prompt), version])
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(self, agent_type, prompt, version):
+        key = self.key(agent_type, prompt, version)
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # callers extend the returned lists, e.g. with more locations
+                return copy.deepcopy(self.entries[key])
+
+        response = None
+        if self.cache_path:
+            with self._connect() as connection:
+                row = connection.execute(
+                    "SELECT response FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+            if row is not None:
+                response = json.loads(row[0])
+                self._remember(key, response)
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return copy.deepcopy(response)
+
+    def put(self, agent_type, prompt, version, response):
+        key = self.key(agent_type, prompt, version)
+        self._remember(key, response)
+
+        if self.cache_path:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?)",
+                    (key, json.dumps(response)),
+                )
+
+    def _remember(self, key, response):
+        with self._lock:
+            self.entries[key] = copy.deepcopy(response)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def metrics(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
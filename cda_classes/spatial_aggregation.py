@@ -0,0 +1,102 @@
+import hashlib
+import threading
+
+import numpy as np
+import xarray as xr
+
+from collections import OrderedDict
+from loguru import logger
+from utils.utils import apply_timing_decorator
+
+# Optional ERA5-Land land-sea mask ("lsm", e.g. the invariant GRIB file of the
+# CDS). Grid points below the threshold are left out of the spatial means,
+# None weights all points that have data.
+LAND_SEA_MASK_PATH = None
+LAND_SEA_MASK_THRESHOLD = 0.5
+
+SPATIAL_WEIGHTS_MAX_ENTRIES = 64
+
+
+def latitude_weights(latitude):
+    # the area of a regular lat/lon grid cell shrinks with cos(lat)
+    return np.clip(np.cos(np.deg2rad(np.asarray(latitude, dtype=np.float64))), 0.0, None)
+
+
+# Class to average fields over their area. The flattened cos(lat) weights,
+# multiplied with the land-sea mask if one is configured, are computed once
+# per grid and every spatial mean is a NaN aware dot product with them.
+@apply_timing_decorator
+class SpatialAggregator():
+    def __init__(
+        self,
+        land_sea_mask_path=LAND_SEA_MASK_PATH,
+        max_entries=SPATIAL_WEIGHTS_MAX_ENTRIES,
+    ):
+        self.land_sea_mask = None
+        if land_sea_mask_path:
+            land_sea_mask = xr.open_dataset(land_sea_mask_path, engine="cfgrib")["lsm"]
+            self.land_sea_mask = land_sea_mask.squeeze(drop=True).load()
+            logger.info(f"Loaded the land-sea mask of '{land_sea_mask_path}'")
+        self.max_entries = max_entries
+        self.weights = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_weights(self, latitude, longitude):
+        """
+        Returns:
+            numpy.ndarray: Weight of every point of the latitude x
+            longitude grid, flattened in C order.
+        """
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        grid_key = hashlib.sha1(latitude.tobytes() + b"|" + longitude.tobytes()).hexdigest()
+
+        with self._lock:
+            if grid_key in self.weights:
+                self.weights.move_to_end(grid_key)
+                return self.weights[grid_key]
+
+        weights = np.outer(latitude_weights(latitude), np.ones(len(longitude)))
+        if self.land_sea_mask is not None:
+            land_sea_mask = self.land_sea_mask.sel(
+                latitude=latitude, longitude=longitude, method="nearest"
+            ).values
+            weights = weights * (land_sea_mask >= LAND_SEA_MASK_THRESHOLD)
+        weights = weights.ravel()
+
+        with self._lock:
+            self.weights[grid_key] = weights
+            if len(self.weights) > self.max_entries:
+                self.weights.popitem(last=False)
+        return weights
+
+    def spatial_mean(self, data):
+        """
+        Area weighted mean of a DataArray over latitude and longitude,
+        missing values (e.g. the sea in ERA5-Land) are left out.
+
+        Returns:
+            xarray.DataArray: The data without the spatial dimensions,
+            NaN where no point with data and weight is left.
+        """
+        data = data.transpose(..., "latitude", "longitude")
+        weights = self.get_weights(data["latitude"].values, data["longitude"].values)
+
+        values = data.values.reshape(data.shape[:-2] + (-1,))
+        is_valid = ~np.isnan(values)
+        weighted_sum = np.where(is_valid, values, 0.0) @ weights
+        weight_sum = is_valid @ weights
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(weight_sum > 0, weighted_sum / weight_sum, np.nan)
+
+        return xr.DataArray(
+            mean,
+            dims=data.dims[:-2],
+            coords={
+                name: coord
+                for name, coord in data.coords.items()
+                if not set(coord.dims) & {"latitude", "longitude"}
+                and name not in ["latitude", "longitude"]
+            },
+        )
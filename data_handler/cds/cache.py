@@ -0,0 +1,128 @@
+import os
+import glob
+import json
+import hashlib
+import tempfile
+import threading
+
+from collections import defaultdict
+from loguru import logger
+from utils.utils import apply_timing_decorator
+
+# Class to keep the files downloaded from the CDS, keyed by a hash of the
+# request, so that repeated and overlapping questions never leave the machine
+@apply_timing_decorator
+class DownloadCache():
+    # Shared by all instances, so identical requests of concurrent
+    # sessions wait for the first download instead of repeating it
+    _key_locks = defaultdict(threading.Lock)
+    _key_locks_lock = threading.Lock()
+
+    def __init__(self, cache_folder, max_size_bytes):
+        self.cache_folder = cache_folder
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+    def key(self, name, request):
+        """
+        Canonical hash of a CDS request. Lists whose order carries no meaning
+        (years, months, days, variables, times) are sorted; the area keeps its
+        [north, west, south, east] order.
+        """
+        canonical_request = {}
+        for key, value in request.items():
+            if isinstance(value, (list, tuple)) and key != "area":
+                value = sorted(str(item) for item in value)
+            elif key == "area" and value is not None:
+                value = [round(float(coordinate), 4) for coordinate in value]
+            canonical_request[key] = value
+
+        serialized = json.dumps(
+            {"name": name, "request": canonical_request}, sort_keys=True
+        )
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def fetch(self, name, request, download_function):
+        """
+        Return the cached file of a request, downloading it on a miss.
+
+        Args:
+            download_function (callable): Writes the data of the request
+                to the target path it receives.
+
+        Returns:
+            str: Path of the cached file.
+        """
+        key = self.key(name, request)
+        path = os.path.join(self.cache_folder, f"{key}.{request.get('data_format', 'grib')}")
+
+        with self._key_locks_lock:
+            key_lock = self._key_locks[path]
+
+        with key_lock:
+            if os.path.isfile(path):
+                with self._lock:
+                    self.hits += 1
+                os.utime(path)  # mark as recently used
+                logger.info(f"CDS cache hit for {name} ({key[:12]})")
+                return path
+
+            with self._lock:
+                self.misses += 1
+            logger.info(f"CDS cache miss for {name} ({key[:12]})")
+
+            # Write to a temporary file first so readers never see partial data
+            file_descriptor, temporary_path = tempfile.mkstemp(
+                dir=self.cache_folder, suffix=".part"
+            )
+            os.close(file_descriptor)
+            try:
+                download_function(temporary_path)
+                os.replace(temporary_path, path)
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+
+        self.evict()
+        return path
+
+    def evict(self):
+        """
+        Remove the least recently used files until the
+        cache is below its maximum size again.
+        """
+        with self._lock:
+            cached_files = [
+                entry for entry in os.scandir(self.cache_folder)
+                if entry.is_file()
+                and not entry.name.endswith((".part", ".idx"))
+            ]
+            total_size = sum(entry.stat().st_size for entry in cached_files)
+
+            for entry in sorted(cached_files, key=lambda entry: entry.stat().st_mtime):
+                if total_size <= self.max_size_bytes:
+                    break
+                try:
+                    file_size = entry.stat().st_size
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue  # already evicted by another process
+                total_size -= file_size
+                # cfgrib keeps its index files next to the data
+                for index_file in glob.glob(f"{entry.path}.*.idx"):
+                    os.remove(index_file)
+                self.evictions += 1
+                logger.info(f"Evicted '{entry.name}' from the CDS cache")
+
+    def metrics(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
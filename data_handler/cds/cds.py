@@ -1,20 +1,51 @@
 import cdsapi
 import xarray as xr
 import pathlib
+import threading
+import time
 import numpy as np
 
 from utils.utils import Utilities
 from cda_classes.eorequest import EORequest
+from data_handler.cds.cache import DownloadCache
+from data_handler.cds.request_planner import CdsRequestPlanner
 from loguru import logger
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from utils.utils import apply_timing_decorator
 
+CDS_CACHE_FOLDER = "cds_cache"
+CDS_CACHE_MAX_SIZE_BYTES = 20 * 1024**3
+
+# Number of CDS jobs that are queued at the same time and their retry policy
+CDS_MAX_CONCURRENT_JOBS = 4
+CDS_MAX_RETRIES = 3
+CDS_RETRY_BACKOFF_SECONDS = 10
+
+# Variables that are always fetched hourly. Wind speed needs the hourly
+# components, since the speed of the mean wind components underestimates the
+# mean speed. The monthly means of the accumulated variables (total
+# precipitation, evaporation) are daily mean accumulations, with another
+# meaning and scale than the 12:00 field of the hourly product.
+MONTHLY_MEANS_EXCLUDED_VARIABLES = ['w10', 'tp', 'e']
+
 # Class to process the request of the User when he is asking for CDS Data
 @apply_timing_decorator
 class ClimateDataStorageHandler():
-    def __init__(self):
-
-        self.client = cdsapi.Client()
+    def __init__(
+        self, 
+        client_factory=cdsapi.Client, 
+        max_concurrent_jobs=CDS_MAX_CONCURRENT_JOBS,
+        max_retries=CDS_MAX_RETRIES,
+        retry_backoff_seconds=CDS_RETRY_BACKOFF_SECONDS,
+    ):
+        # The factory allows pointing the handler to another (e.g. local fake) CDS
+        self.client_factory = client_factory
+        self.client = client_factory()
+        self._thread_local = threading.local()
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
         logger.info("Successfully log to Climate Data Store")
         self.load_request_format()
         self.years = []
@@ -22,10 +53,22 @@ class ClimateDataStorageHandler():
         self.variable = None
         self.days = []
         self.months = []
+        self.monthly_means = False
+        self.cds_request = self.request_format["cds_request"]
+        self.download_cache = DownloadCache(CDS_CACHE_FOLDER, CDS_CACHE_MAX_SIZE_BYTES)
+        self.request_planner = CdsRequestPlanner()
         
     def construct_request(self, eo_request: EORequest):
         
-        self.cds_request_format = self.request_format["cds_request"]["request"]
+        # Long basic analyses and comparisons only need monthly means
+        self.monthly_means = self.use_monthly_means(eo_request)
+        if self.monthly_means:
+            self.cds_request = self.request_format["cds_request_monthly_means"]
+            logger.info(f"Using the pre-aggregated product '{self.cds_request['name']}'")
+        else:
+            self.cds_request = self.request_format["cds_request"]
+        self.cds_request_format = self.cds_request["request"]
+        self.requests = []
         
         for sub_request in eo_request.collected_sub_requests:
             
@@ -47,34 +90,158 @@ class ClimateDataStorageHandler():
             request["variable"] = eo_request.variable
             request["year"] = self.years
             request["month"] = self.months
-            request['days'] = self.days
+            if not self.monthly_means:
+                request["day"] = self.days
             request["area"] = sub_request.abbox
             self.datatype = self.cds_request_format["data_format"]
             
             self.requests.append(request)
 
-    def get_data(self, collected_sub_requests):
+    def get_data(self, collected_sub_requests, progress_callback=None):
+        """
+        Coalesce the sub-requests into as few CDS calls as possible, split
+        large calls into time chunks and stream them: while max_concurrent_jobs
+        chunks download, the finished ones are decoded, cut to the sub-requests
+        they serve and closed, so only the reduced arrays stay in memory.
+
+        Args:
+            progress_callback (callable): Called with (finished, total)
+                from the calling thread after each finished CDS call.
+        """
+        name = self.cds_request["name"]
+        planned_requests = self.request_planner.plan(
+            collected_sub_requests, self.monthly_means
+        )
+        logger.info(
+            f"Planned {len(planned_requests)} CDS request(s) "
+            f"for {len(collected_sub_requests)} sub-request(s)"
+        )
         
-        for sub_request, request in zip(collected_sub_requests, self.requests):
-            name = self.request_format["cds_request"]["name"]
+        data_parts = {id(sub_request): [] for sub_request in collected_sub_requests}
+        pending_requests = iter(planned_requests)
+        finished = 0
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrent_jobs)
+        futures = {}
+        
+        def submit_next():
+            planned_request = next(pending_requests, None)
+            if planned_request is None:
+                return
+            request = planned_request.to_cds_request(self.requests[0])
             print(request, name)
-            result = self.client.retrieve(name, request)
-            file = self.download("ERA_5", self.location, result)
-            ds = self.process(file)
-            if sub_request.variable_shortname == 'w10':
-                ds_opened = self._process_windspeed(ds)
-            else:
-                ds_opened = ds[sub_request.variable_shortname]
-            sub_request.append_request_data(ds_opened)
+            future = executor.submit(self._download_with_retries, name, request)
+            futures[future] = planned_request
+        
+        try:
+            # Keep one chunk queued behind the running downloads, no more
+            for _ in range(self.max_concurrent_jobs + 1):
+                submit_next()
+            
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    planned_request = futures.pop(future)
+                    self._process_chunk(future.result(), planned_request, data_parts)
+                    submit_next()
+                    
+                    finished += 1
+                    if progress_callback:
+                        progress_callback(finished, len(planned_requests))
+        except Exception:
+            # Do not wait for the other downloads once one chunk failed for good
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        
+        for sub_request in collected_sub_requests:
+            sub_request.append_request_data(
+                self.request_planner.combine(data_parts[id(sub_request)])
+            )
+        
+        logger.info(f"CDS cache metrics: {self.download_cache.metrics()}")
 
-    
-    def download(self, filename, location, result):
+    def _process_chunk(self, file, planned_request, data_parts):
         """
+        Decode one downloaded chunk and keep only the loaded
+        subsets of the sub-requests it serves.
+        """
+        ds = self.process(file)
+        try:
+            for sub_request in planned_request.sub_requests:
+                if sub_request.variable_shortname == 'w10':
+                    ds_opened = self._process_windspeed(ds)
+                else:
+                    ds_opened = ds[sub_request.variable_shortname]
+                subset = self.request_planner.split(
+                    ds_opened, sub_request, self.monthly_means
+                )
+                if subset is not None:
+                    data_parts[id(sub_request)].append(subset.load())
+        finally:
+            ds.close()
+
+    def use_monthly_means(self, eo_request: EORequest):
+        """
+        Decide whether the monthly means product is sufficient: the analysis
+        reduces the data to means anyway and every sub-request spans at least
+        min_months months. Never for MONTHLY_MEANS_EXCLUDED_VARIABLES, so their
+        statistics do not depend on the length of the request.
+        """
+        monthly_format = self.request_format.get("cds_request_monthly_means")
+        if (
+            monthly_format is None 
+            or eo_request.variable_short_name in MONTHLY_MEANS_EXCLUDED_VARIABLES
+        ):
+            return False
+        if not eo_request.request_analysis or (
+            eo_request.request_analysis[0] not in monthly_format["analyses"]
+        ):
+            return False
+        
+        for sub_request in eo_request.collected_sub_requests:
+            start_date = sub_request.timeframe_object.startdate
+            end_date = sub_request.timeframe_object.enddate
+            months = (end_date.year - start_date.year) * 12 + end_date.month - start_date.month + 1
+            if months < monthly_format["min_months"]:
+                return False
+        return True
+
+    def _download_with_retries(self, name, request):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                return self.download(name, request)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"CDS request failed after {attempt} attempts: {e}")
+                    raise
+                backoff = self.retry_backoff_seconds * 2 ** (attempt - 1)
+                logger.warning(
+                    f"CDS request attempt {attempt} failed with error: {e}. "
+                    f"Retrying in {backoff} seconds"
+                )
+                time.sleep(backoff)
+    
+    def _get_client(self):
+        # cdsapi clients keep a requests session, so every worker thread gets its own
+        if not hasattr(self._thread_local, "client"):
+            self._thread_local.client = self.client_factory()
+        return self._thread_local.client
+    
+    def download(self, name, request):
         """
-        filename = f"{filename}_{location}.{self.datatype}"
-        result.download(filename)
+        Retrieve the request from the CDS unless the same request
+        was downloaded before and is still in the download cache.
         
-        return filename
+        Returns:
+            str: Path of the file in the download cache.
+        """
+        return self.download_cache.fetch(
+            name,
+            request,
+            lambda target: self._get_client().retrieve(name, request).download(target),
+        )
     
     def process(self, file):
         """
@@ -137,7 +304,14 @@ class ClimateDataStorageHandler():
         start_date = timeframe_object.startdate
         end_date = timeframe_object.enddate
         
-        self.months = sorted({str(month).zfill(2) for month in range(start_date.month, end_date.month + 1)})
+        # Walk month by month, so ranges across the turn of a year are covered too
+        months = set()
+        current_month = start_date.replace(day=1)
+        while current_month <= end_date:
+            months.add(f"{current_month.month:02}")
+            current_month = (current_month + timedelta(days=32)).replace(day=1)
+        
+        self.months = sorted(months)
         
         
     def load_request_format(self):
@@ -0,0 +1,227 @@
+import xarray as xr
+
+from collections import defaultdict
+from datetime import timedelta
+from utils.utils import apply_timing_decorator
+
+# Fixed cost of queuing one more CDS job, expressed in the same unit as the
+# size of a request (square degrees x number of requested days). A job waits
+# about a minute in the CDS queue, roughly the time to retrieve and decode
+# one month of a 3°x3° box.
+CDS_JOB_OVERHEAD = 9 * 31
+
+# Data that a merge fetches on top of its two parts, relative to their
+# size. Merges beyond it are rejected even if they save a job, so that
+# e.g. Nov 2020-Feb 2021 is not widened to Jan-Dec of both years.
+CDS_MAX_OVERFETCH_RATIO = 0.25
+
+# Largest request that is downloaded and decoded in one piece, in the same
+# unit. At the 0.1° ERA5-Land grid this is about 400 MB of decoded float32
+# values, larger requests are split into chunks of whole years (or months).
+CDS_MAX_CHUNK_SIZE = 1_000_000
+
+# Class for one CDS call that serves one or several sub-requests
+class PlannedRequest():
+    def __init__(self, area, years, months, days, sub_requests):
+        self.area = area  # [north, west, south, east]
+        self.years = set(years)
+        self.months = set(months)
+        self.days = set(days)
+        self.sub_requests = list(sub_requests)
+
+    def size(self):
+        north, west, south, east = self.area
+        area_size = max(north - south, 0.1) * max(east - west, 0.1)
+        # monthly means carry no days, one field per month
+        return area_size * len(self.years) * len(self.months) * max(len(self.days), 1)
+
+    def merge(self, other):
+        sub_requests = self.sub_requests + [
+            sub_request for sub_request in other.sub_requests
+            if all(sub_request is not existing for existing in self.sub_requests)
+        ]
+        return PlannedRequest(
+            [
+                max(self.area[0], other.area[0]),
+                min(self.area[1], other.area[1]),
+                min(self.area[2], other.area[2]),
+                max(self.area[3], other.area[3]),
+            ],
+            self.years | other.years,
+            self.months | other.months,
+            self.days | other.days,
+            sub_requests,
+        )
+
+    def to_cds_request(self, base_request):
+        request = base_request.copy()
+        request["year"] = [str(year) for year in sorted(self.years)]
+        request["month"] = [f"{month:02}" for month in sorted(self.months)]
+        if self.days:
+            request["day"] = [f"{day:02}" for day in sorted(self.days)]
+        request["area"] = self.area
+        return request
+
+
+# Class to coalesce the sub-requests of an EORequest into the smallest set of
+# CDS calls and to split the returned data back per sub-request
+@apply_timing_decorator
+class CdsRequestPlanner():
+    def __init__(
+        self,
+        job_overhead=CDS_JOB_OVERHEAD,
+        max_chunk_size=CDS_MAX_CHUNK_SIZE,
+        max_overfetch_ratio=CDS_MAX_OVERFETCH_RATIO,
+    ):
+        self.job_overhead = job_overhead
+        self.max_chunk_size = max_chunk_size
+        self.max_overfetch_ratio = max_overfetch_ratio
+
+    def plan(self, collected_sub_requests, monthly=False):
+        """
+        Build the CDS calls for all sub-requests. Each sub-request is first
+        described by exact year x month x day blocks, then blocks are merged
+        as long as the merged call is cheaper than queuing both separately
+        and fetches at most max_overfetch_ratio more data than both.
+        Calls larger than max_chunk_size are finally split into time chunks.
+
+        Args:
+            monthly (bool): Plan for a monthly product, blocks without days.
+
+        Returns:
+            list: PlannedRequest objects covering every sub-request.
+        """
+        planned_requests = []
+        for sub_request in collected_sub_requests:
+            planned_requests.extend(self._exact_blocks(sub_request, monthly))
+
+        chunks = []
+        for planned_request in self._merge_blocks(planned_requests):
+            chunks.extend(self._chunk(planned_request))
+        return chunks
+
+    def _exact_blocks(self, sub_request, monthly=False):
+        """
+        Decompose the dates of a sub-request into CDS requests whose
+        year x month x day product contains exactly these dates.
+        """
+        days_per_month = defaultdict(set)
+        current_date = sub_request.timeframe_object.startdate
+        while current_date <= sub_request.timeframe_object.enddate:
+            days = days_per_month[(current_date.year, current_date.month)]
+            if not monthly:
+                days.add(current_date.day)
+            current_date += timedelta(days=1)
+
+        # Months with the same days, then months with the same years
+        years_per_days_and_month = defaultdict(set)
+        for (year, month), days in days_per_month.items():
+            years_per_days_and_month[(frozenset(days), month)].add(year)
+
+        months_per_block = defaultdict(set)
+        for (days, month), years in years_per_days_and_month.items():
+            months_per_block[(days, frozenset(years))].add(month)
+
+        return [
+            PlannedRequest(sub_request.abbox, years, months, days, [sub_request])
+            for (days, years), months in months_per_block.items()
+        ]
+
+    def _cost(self, planned_request):
+        return self.job_overhead + planned_request.size()
+
+    def _merge_blocks(self, planned_requests):
+        # Greedily apply the merge with the largest saving until none is left
+        while len(planned_requests) > 1:
+            best_saving, best_pair = 0, None
+            for i in range(len(planned_requests)):
+                for j in range(i + 1, len(planned_requests)):
+                    first, second = planned_requests[i], planned_requests[j]
+                    merged = first.merge(second)
+                    parts_size = first.size() + second.size()
+                    if merged.size() - parts_size > self.max_overfetch_ratio * parts_size:
+                        continue
+
+                    saving = self._cost(first) + self._cost(second) - self._cost(merged)
+                    if saving > best_saving:
+                        best_saving, best_pair = saving, (i, j)
+
+            if best_pair is None:
+                break
+
+            i, j = best_pair
+            merged = planned_requests[i].merge(planned_requests[j])
+            planned_requests = [
+                planned_request for idx, planned_request in enumerate(planned_requests)
+                if idx not in best_pair
+            ] + [merged]
+
+        return planned_requests
+
+    def _chunk(self, planned_request):
+        """
+        Split a planned request into groups of whole years, or of single
+        months if one year is still too large. Each chunk keeps the exact
+        month x day product of the planned request.
+        """
+        if planned_request.size() <= self.max_chunk_size:
+            return [planned_request]
+
+        year_size = planned_request.size() / len(planned_request.years)
+        if year_size > self.max_chunk_size:
+            return [
+                PlannedRequest(
+                    planned_request.area, [year], [month],
+                    planned_request.days, planned_request.sub_requests,
+                )
+                for year in sorted(planned_request.years)
+                for month in sorted(planned_request.months)
+            ]
+
+        years_per_chunk = max(int(self.max_chunk_size // year_size), 1)
+        years = sorted(planned_request.years)
+        return [
+            PlannedRequest(
+                planned_request.area, years[i:i + years_per_chunk],
+                planned_request.months, planned_request.days,
+                planned_request.sub_requests,
+            )
+            for i in range(0, len(years), years_per_chunk)
+        ]
+
+    def split(self, data, sub_request, monthly=False):
+        """
+        Cut the area and the dates of one sub-request out of
+        the data that was returned for a planned request.
+
+        Returns:
+            xarray.DataArray: The lazy subset, or None if the
+            planned request holds no data of the sub-request.
+        """
+        area = sub_request.abbox
+        if "time" not in data.dims:
+            data = data.expand_dims("time")  # files with a single time step
+        # monthly means are stamped with the first day of their month
+        start_format = "%Y-%m-01" if monthly else "%Y-%m-%d"
+        data = data.sel(
+            time=slice(
+                sub_request.timeframe_object.startdate.strftime(start_format),
+                sub_request.timeframe_object.enddate.strftime("%Y-%m-%d"),
+            ),
+            latitude=slice(area[0], area[2]),
+            longitude=slice(area[1], area[3]),
+        )
+        # cfgrib returns all time steps when an empty selection is loaded
+        if data.size == 0:
+            return None
+        return data
+
+    def combine(self, data_parts):
+        """
+        Join the parts of one sub-request that came from different
+        planned requests into a single time series.
+        """
+        if not data_parts:
+            return None
+        combined = xr.concat(data_parts, dim="time").sortby("time")
+        return combined.drop_duplicates("time")
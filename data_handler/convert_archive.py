@@ -0,0 +1,30 @@
+import argparse
+
+from data_handler.data_handler import GRIB_ARCHIVE_FOLDER, ZARR_ARCHIVE_PATH
+from data_handler.grib_index import GribArchiveIndex
+from data_handler.zarr_store import ZarrArchive
+
+# Converts the monthly GRIB archive into the chunked Zarr store read by the
+# DataHandler. Run it once for the full archive and again whenever new
+# months were added, e.g.:
+#   python -m data_handler.convert_archive --variables t2m tp
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert the local ERA5-Land GRIB archive into a Zarr store"
+    )
+    parser.add_argument("--grib-folder", default=GRIB_ARCHIVE_FOLDER)
+    parser.add_argument("--store", default=ZARR_ARCHIVE_PATH)
+    parser.add_argument("--variables", nargs="*", default=None)
+    parser.add_argument("--time-chunk", type=int, default=31)
+    parser.add_argument("--spatial-chunk", type=int, default=60)
+    parser.add_argument(
+        "--rebuild", action="store_true",
+        help="Rewrite the store instead of only converting new or changed files"
+    )
+    args = parser.parse_args()
+
+    zarr_archive = ZarrArchive(args.store, args.time_chunk, args.spatial_chunk)
+    zarr_archive.convert(
+        GribArchiveIndex(args.grib_folder), args.variables, args.rebuild
+    )
@@ -1,101 +1,283 @@
 import os
-import cfgrib
+import threading
+import multiprocessing
 import xarray as xr
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor
+
 from data_handler.cds import ClimateDataStorageHandler
+from data_handler.grib_index import GribArchiveIndex
+from data_handler.zarr_store import ZarrArchive
 from cda_classes.eorequest import EORequest
 from utils.utils import apply_timing_decorator
 
+GRIB_ARCHIVE_FOLDER = '/my_volume/cds_data/ERA_5_LAND_2000_2024'
+ZARR_ARCHIVE_PATH = '/my_volume/cds_data/ERA_5_LAND_2000_2024.zarr'
+
+# Number of processes decoding GRIB files in parallel, 1 decodes in-process
+GRIB_DECODE_WORKERS = os.cpu_count() or 1
+
+# Areas of one GRIB file are read together while their envelope is at most
+# this many times the sum of their sizes, e.g. neighbouring or overlapping
+# cities. Distant areas (Lisbon and Tokyo) are read one by one instead of
+# loading a near-global box.
+GRIB_ENVELOPE_MAX_RATIO = 2.0
+
+# One pool per worker count, shared by all DataHandlers and created on first use
+_decode_executors = {}
+_decode_executors_lock = threading.Lock()
+
+
+def area_size(area):
+    north, west, south, east = area
+    return max(north - south, 0.1) * max(east - west, 0.1)
+
+
+def envelope(areas):
+    return [
+        max(area[0] for area in areas),
+        min(area[1] for area in areas),
+        min(area[2] for area in areas),
+        max(area[3] for area in areas),
+    ]
+
+
+def group_areas(target_areas, max_ratio=GRIB_ENVELOPE_MAX_RATIO):
+    """
+    Group the indices of areas whose common envelope stays close
+    to the sum of their sizes.
+
+    Returns:
+        list: Lists of indices into target_areas.
+    """
+    groups = []
+    for idx, area in enumerate(target_areas):
+        for group in groups:
+            areas = [target_areas[member] for member in group] + [area]
+            if area_size(envelope(areas)) <= max_ratio * sum(map(area_size, areas)):
+                group.append(idx)
+                break
+        else:
+            groups.append([idx])
+    return groups
+
+
+def decode_grib_file(grib_file_path, grib_short_names, target_variables, target_areas):
+    """
+    Decode the messages of the target variables in one GRIB file and cut out
+    every target area ([north, west, south, east]), nearby areas are read
+    together. Runs in the worker processes of the DataHandler, so the results
+    are in memory when returned.
+
+    Returns:
+        list: One xarray.Dataset per target area.
+    """
+    dataset = xr.open_dataset(
+        grib_file_path,
+        engine='cfgrib',
+        backend_kwargs={'filter_by_keys': {'shortName': grib_short_names}},
+    )
+
+    # Read the envelope of each group of nearby areas a single time, then cut in memory
+    decoded_areas = [None] * len(target_areas)
+    for group in group_areas(target_areas):
+        north, west, south, east = envelope([target_areas[idx] for idx in group])
+        ds_envelope = dataset[target_variables].sel(
+            latitude=slice(north, south),
+            longitude=slice(west, east),
+        ).load()
+
+        for idx in group:
+            decoded_areas[idx] = ds_envelope.sel(
+                latitude=slice(target_areas[idx][0], target_areas[idx][2]), 
+                longitude=slice(target_areas[idx][1], target_areas[idx][3])
+            )
+    dataset.close()
+
+    return decoded_areas
+
+
+def get_decode_executor(workers=GRIB_DECODE_WORKERS):
+    # Spawned workers do not inherit the state of the LLM process
+    with _decode_executors_lock:
+        if workers not in _decode_executors:
+            _decode_executors[workers] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _decode_executors[workers]
+
+
 # Class to transform the parameters into a valid request
 @apply_timing_decorator
 class DataHandler():
-    def __init__(self, ):
+    def __init__(self, decode_workers=GRIB_DECODE_WORKERS):
         self.request_cds = ClimateDataStorageHandler()
         # self.cds = ClimateDataStorageHandler(self.request)
         self.data_available_in_db = False
         self.processed_datasets = {}
+        self.grib_index = GribArchiveIndex(GRIB_ARCHIVE_FOLDER)
+        self.zarr_archive = ZarrArchive(ZARR_ARCHIVE_PATH)
+        self.decode_workers = decode_workers
         
     def construct_request(self, eo_request: EORequest):
         # if (eo_request.datasource == "CDS"):
         self.request_cds.construct_request(eo_request)
     
-    def download(self,  eo_request: EORequest):
+    def download(self,  eo_request: EORequest, progress_callback=None):
         
         self.construct_request(eo_request)
         self.check_for_data_in_database(eo_request)
         if not self.data_available_in_db:
-            self.request_cds.get_data(eo_request.collected_sub_requests)
+            self.request_cds.get_data(
+                eo_request.collected_sub_requests, progress_callback
+            )
             
     def check_for_data_in_database(self, eo_request):
         self.data_available_in_db = True
-        grib_folder = '/my_volume/cds_data/ERA_5_LAND_2000_2024'
         
+        # Handle special case of wind speed variable
+        if eo_request.variable_short_name == 'w10':
+            target_variables = ['u10', 'v10']
+        else:    
+            target_variables = [eo_request.variable_short_name]
+        
+        missing_sub_requests = []
         for sub_request, request in zip(
             eo_request.collected_sub_requests, 
             self.request_cds.requests
         ):
-            
-            target_years = request['year']
-            target_months = request['month']
-            target_area = request['area']
-            
-            # Handle special case of wind speed variable
-            if eo_request.variable_short_name == 'w10':
-                target_variable = 'u10'
-            else:    
-                target_variable = eo_request.variable_short_name
-
-            # Get all files in the grib folder
-            files_in_folder = [f for f in os.listdir(grib_folder) if f.endswith('.grib')]
-
-            # Filter files by target years and months
-            filtered_files = [
-                f for f in files_in_folder 
-                if any(f.startswith(f"{int(year)}_{int(month):02d}") for year in target_years for month in target_months)
-            ]
+            ds_database = None
 
-            # Sort the filenames for consistency
-            filtered_files.sort()
+            # Prefer the chunked Zarr store, fall back to the GRIB files
+            if self.zarr_archive.exists():
+                ds_database = self._load_from_zarr(
+                    sub_request, request, target_variables, eo_request.variable_short_name
+                )
 
-            datasets = []  # To concatenate the months to one xarray dataset
+            if ds_database is None:
+                missing_sub_requests.append((sub_request, request))
+            else:
+                sub_request.append_request_data(ds_database)
 
-            # Loop through filtered files and process them
-            for filename in filtered_files:
-                grib_file_path = os.path.join(grib_folder, filename)
+        if not missing_sub_requests:
+            return
 
-                # Open the GRIB file using cfgrib
-                ds_list = cfgrib.open_datasets(grib_file_path)
-                
-                # Loop through datasets and filter by the target variable and area
-                for i, dataset in enumerate(ds_list):
-                    if target_variable in dataset.data_vars:
-                        try:
-                            if target_variable == 'u10':
-                                ds_filtered = self._process_windspeed_of_db(dataset, target_area)
-                            else:
-                                ds_filtered = dataset[target_variable].sel(
-                                    latitude=slice(target_area[0], target_area[2]), 
-                                    longitude=slice(target_area[1], target_area[3])
-                                )
-                            datasets.append(ds_filtered)
-                        except Exception as e:
-                            print(f"Error processing dataset: {e}")
-                            self.data_available_in_db = False
-
-            # Concatenate all the datasets once after loading them
-            if datasets:
-                ds_database = xr.concat(datasets, dim='time')
-                ds_sorted = ds_database.sortby('time')  # Sort by the time coordinate
-            
-                # Check if the dataset is empty by checking the size or any of the dimensions
-                if ds_sorted.size == 0:
-                    self.data_available_in_db = False
-                else:
-                    # Save the sorted dataset in the processed datasets dictionary
-                    sub_request.append_request_data(ds_sorted)
+        # Rescan only the GRIB files that changed since the last request
+        self.grib_index.update()
+        grib_datasets = self._load_from_grib(
+            [request for _, request in missing_sub_requests],
+            target_variables,
+            eo_request.variable_short_name,
+        )
+
+        for (sub_request, _), ds_database in zip(missing_sub_requests, grib_datasets):
+            # Check if the dataset is empty by checking the size or any of the dimensions
+            if ds_database is None or ds_database.size == 0:
+                self.data_available_in_db = False
             else:
+                # Save the sorted dataset in the processed datasets dictionary
+                sub_request.append_request_data(ds_database)
+
+    def _load_from_zarr(self, sub_request, request, target_variables, variable_short_name):
+        dataset = self.zarr_archive.read(
+            target_variables,
+            request['area'],
+            sub_request.timeframe_object.startdate,
+            sub_request.timeframe_object.enddate,
+        )
+        if dataset is None:
+            return None
+
+        if variable_short_name == 'w10':
+            return self._process_windspeed_of_db(dataset, request['area'])
+        return dataset[variable_short_name]
+
+    def _load_from_grib(self, requests, target_variables, variable_short_name):
+        """
+        Decode and subset the GRIB files of all given requests. Every file is
+        decoded once and concurrently when more than one worker is configured.
+
+        Returns:
+            list: Per request the data sorted by time, or None if nothing was found.
+        """
+        grib_short_names = list(
+            self.grib_index.grib_short_names(target_variables).values()
+        )
+
+        # One task per file, shared by all requests that need it
+        planned_files = self._plan_grib_files(requests, target_variables)
+        decoded_datasets = self._run_decode_tasks(
+            [
+                (
+                    grib_file_path, 
+                    grib_short_names, 
+                    target_variables, 
+                    [requests[request_idx]['area'] for request_idx in request_indices],
+                )
+                for grib_file_path, request_indices in planned_files.items()
+            ]
+        )
+
+        # To concatenate the months of each request to one xarray dataset
+        datasets = [[] for _ in requests]
+        for request_indices, file_datasets in zip(planned_files.values(), decoded_datasets):
+            if file_datasets is None:
                 self.data_available_in_db = False
+                continue
+
+            for request_idx, dataset in zip(request_indices, file_datasets):
+                if variable_short_name == 'w10':
+                    datasets[request_idx].append(
+                        self._process_windspeed_of_db(dataset, requests[request_idx]['area'])
+                    )
+                else:
+                    datasets[request_idx].append(dataset[variable_short_name])
+
+        return [
+            xr.concat(request_datasets, dim='time').sortby('time')
+            if request_datasets else None
+            for request_datasets in datasets
+        ]
+
+    def _plan_grib_files(self, requests, target_variables):
+        """
+        Group the requests by the GRIB files they need, so that each file
+        is decoded once no matter how many locations or time ranges use it.
+
+        Returns:
+            dict: GRIB file path -> indices of the requests that need it.
+        """
+        planned_files = {}
+        for request_idx, request in enumerate(requests):
+            for grib_file_path in self.grib_index.find_files(
+                target_variables, request['year'], request['month']
+            ):
+                planned_files.setdefault(grib_file_path, []).append(request_idx)
+
+        return dict(sorted(planned_files.items()))
+
+    def _run_decode_tasks(self, tasks):
+        if self.decode_workers > 1 and len(tasks) > 1:
+            executor = get_decode_executor(self.decode_workers)
+            futures = [executor.submit(decode_grib_file, *task) for task in tasks]
+        else:
+            futures = None
+
+        decoded_datasets = []
+        for idx, task in enumerate(tasks):
+            try:
+                if futures:
+                    decoded_datasets.append(futures[idx].result())
+                else:
+                    decoded_datasets.append(decode_grib_file(*task))
+            except Exception as e:
+                print(f"Error processing dataset: {e}")
+                decoded_datasets.append(None)
+
+        return decoded_datasets
+
                 
     def _process_windspeed_of_db(self, ds, target_area):
         ds_sliced = ds.sel(
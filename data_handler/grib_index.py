@@ -0,0 +1,261 @@
+import os
+import json
+import sqlite3
+import calendar
+import cfgrib
+
+from datetime import datetime
+from loguru import logger
+from utils.utils import apply_timing_decorator
+
+# Class to keep a persistent catalog of the local GRIB archive so a sub-request
+# only has to open the files that hold the requested variable and months
+@apply_timing_decorator
+class GribArchiveIndex():
+    def __init__(self, grib_folder, index_path=None):
+        self.grib_folder = grib_folder
+        self.index_path = index_path or os.path.join(grib_folder, "grib_index.sqlite")
+
+    def _connect(self):
+        return sqlite3.connect(self.index_path)
+
+    def _create_tables(self):
+        with self._connect() as connection:
+            connection.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS files (
+                        filename TEXT PRIMARY KEY,
+                        mtime REAL NOT NULL,
+                        size INTEGER NOT NULL
+                    )
+                """
+            )
+            connection.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS variables (
+                        filename TEXT NOT NULL,
+                        variable TEXT NOT NULL,
+                        grib_short_name TEXT NOT NULL,
+                        time_start TEXT NOT NULL,
+                        time_end TEXT NOT NULL,
+                        lat_min REAL,
+                        lat_max REAL,
+                        lon_min REAL,
+                        lon_max REAL,
+                        offsets TEXT NOT NULL,
+                        PRIMARY KEY (filename, variable)
+                    )
+                """
+            )
+
+    def update(self):
+        """
+        Bring the catalog in line with the GRIB folder. Only files that are new
+        or whose mtime/size changed since the last run are scanned again.
+        """
+        self._create_tables()
+        files_in_folder = {
+            f: os.stat(os.path.join(self.grib_folder, f))
+            for f in os.listdir(self.grib_folder) if f.endswith('.grib')
+        }
+
+        with self._connect() as connection:
+            indexed_files = {
+                filename: (mtime, size)
+                for filename, mtime, size in connection.execute(
+                    "SELECT filename, mtime, size FROM files"
+                )
+            }
+
+            # Remove entries of files that disappeared from the archive
+            removed_files = set(indexed_files) - set(files_in_folder)
+            for filename in removed_files:
+                self._remove_file(connection, filename)
+
+            changed_files = [
+                filename for filename, stat in files_in_folder.items()
+                if indexed_files.get(filename) != (stat.st_mtime, stat.st_size)
+            ]
+            for filename in sorted(changed_files):
+                self._remove_file(connection, filename)
+                self._index_file(connection, filename, files_in_folder[filename])
+
+        if removed_files or changed_files:
+            logger.info(
+                f"GRIB index updated: {len(changed_files)} file(s) scanned, "
+                f"{len(removed_files)} file(s) removed"
+            )
+
+    def _remove_file(self, connection, filename):
+        connection.execute("DELETE FROM files WHERE filename = ?", (filename,))
+        connection.execute("DELETE FROM variables WHERE filename = ?", (filename,))
+
+    def _index_file(self, connection, filename, stat):
+        try:
+            entries = self._scan_file(os.path.join(self.grib_folder, filename))
+        except Exception as e:
+            logger.error(f"Error indexing GRIB file '{filename}': {e}")
+            return
+
+        for variable, entry in entries.items():
+            connection.execute(
+                "INSERT INTO variables VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    filename,
+                    variable,
+                    entry["grib_short_name"],
+                    entry["time_start"].isoformat(),
+                    entry["time_end"].isoformat(),
+                    min(entry["latitudes"]),
+                    max(entry["latitudes"]),
+                    min(entry["longitudes"]),
+                    max(entry["longitudes"]),
+                    json.dumps(entry["offsets"]),
+                ),
+            )
+        connection.execute(
+            "INSERT INTO files VALUES (?, ?, ?)",
+            (filename, stat.st_mtime, stat.st_size),
+        )
+
+    def _scan_file(self, grib_file_path):
+        """
+        Read the message headers of a GRIB file without decoding the values.
+
+        Returns:
+            dict: Per variable the GRIB short name, time range,
+            grid extent and byte offsets of its messages.
+        """
+        entries = {}
+        for offset, message in cfgrib.FileStream(grib_file_path, errors="ignore").items():
+            variable = message.message_get("cfVarName", default=None)
+            if variable in [None, "unknown"]:
+                variable = message["shortName"]
+
+            valid_time = datetime.strptime(
+                f"{message['validityDate']}{int(message['validityTime']):04d}",
+                "%Y%m%d%H%M"
+            )
+            entry = entries.setdefault(
+                variable,
+                {
+                    "grib_short_name": message["shortName"],
+                    "time_start": valid_time,
+                    "time_end": valid_time,
+                    "latitudes": set(),
+                    "longitudes": set(),
+                    "offsets": [],
+                },
+            )
+            entry["time_start"] = min(entry["time_start"], valid_time)
+            entry["time_end"] = max(entry["time_end"], valid_time)
+            entry["latitudes"].update([
+                message["latitudeOfFirstGridPointInDegrees"],
+                message["latitudeOfLastGridPointInDegrees"],
+            ])
+            entry["longitudes"].update([
+                message["longitudeOfFirstGridPointInDegrees"],
+                message["longitudeOfLastGridPointInDegrees"],
+            ])
+            # multi-field messages share their offset
+            offset = offset[0] if isinstance(offset, tuple) else offset
+            if not entry["offsets"] or entry["offsets"][-1] != offset:
+                entry["offsets"].append(int(offset))
+
+        return entries
+
+    def find_files(self, variables, years, months):
+        """
+        Look up the files that contain all of the given variables
+        for at least one of the requested year/month combinations.
+
+        Returns:
+            list: Sorted absolute paths of the matching GRIB files.
+        """
+        target_months = [
+            (
+                datetime(int(year), int(month), 1),
+                datetime(
+                    int(year), int(month),
+                    calendar.monthrange(int(year), int(month))[1], 23, 59
+                ),
+            )
+            for year in years for month in months
+        ]
+
+        matching_variables = {}
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"""
+                    SELECT filename, variable, time_start, time_end FROM variables
+                    WHERE variable IN ({', '.join('?' for _ in variables)})
+                """,
+                list(variables),
+            ).fetchall()
+
+        for filename, variable, time_start, time_end in rows:
+            time_start = datetime.fromisoformat(time_start)
+            time_end = datetime.fromisoformat(time_end)
+            if any(
+                time_start <= month_end and time_end >= month_start
+                for month_start, month_end in target_months
+            ):
+                matching_variables.setdefault(filename, set()).add(variable)
+
+        return sorted(
+            os.path.join(self.grib_folder, filename)
+            for filename, found in matching_variables.items()
+            if found == set(variables)
+        )
+
+    def grib_short_names(self, variables):
+        """
+        Map cfgrib variable names (e.g. 't2m') to the GRIB
+        short names (e.g. '2t') that are used to filter messages.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"""
+                    SELECT DISTINCT variable, grib_short_name FROM variables
+                    WHERE variable IN ({', '.join('?' for _ in variables)})
+                """,
+                list(variables),
+            ).fetchall()
+        return {variable: grib_short_name for variable, grib_short_name in rows}
+
+    def indexed_variables(self):
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT DISTINCT variable FROM variables ORDER BY variable"
+            ).fetchall()
+        return [variable for variable, in rows]
+
+    def list_files(self, variable):
+        """
+        List the indexed files that contain a variable together with
+        their time range and mtime/size, ordered by their first time step.
+
+        Returns:
+            list: Tuples of (path, time_start, time_end, mtime, size).
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                """
+                    SELECT variables.filename, time_start, time_end, mtime, size
+                    FROM variables JOIN files USING (filename)
+                    WHERE variable = ?
+                    ORDER BY time_start
+                """,
+                (variable,),
+            ).fetchall()
+
+        return [
+            (
+                os.path.join(self.grib_folder, filename),
+                datetime.fromisoformat(time_start),
+                datetime.fromisoformat(time_end),
+                mtime,
+                size,
+            )
+            for filename, time_start, time_end, mtime, size in rows
+        ]
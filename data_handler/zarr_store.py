@@ -0,0 +1,153 @@
+import os
+import zarr
+import numpy as np
+import xarray as xr
+
+from loguru import logger
+from data_handler.grib_index import GribArchiveIndex
+from utils.utils import apply_timing_decorator
+
+# Class to mirror the monthly GRIB archive in a Zarr store chunked by
+# (time, lat-tile, lon-tile), so a request only reads the chunks of its area
+@apply_timing_decorator
+class ZarrArchive():
+    def __init__(self, store_path, time_chunk=31, spatial_chunk=60):
+        self.store_path = store_path
+        self.time_chunk = time_chunk
+        self.spatial_chunk = spatial_chunk
+
+    def exists(self):
+        return os.path.isdir(self.store_path)
+
+    def has_variable(self, variable):
+        return os.path.isfile(os.path.join(self.store_path, variable, ".zgroup"))
+
+    def convert(self, grib_index: GribArchiveIndex, variables=None, rebuild=False):
+        """
+        Write the GRIB archive into the Zarr store. Files that were already
+        converted with the same mtime/size are skipped, so running this again
+        after new months arrived only appends the new data.
+        """
+        grib_index.update()
+        variables = variables or grib_index.indexed_variables()
+
+        for variable in variables:
+            if rebuild or not self.has_variable(variable):
+                converted_files = {}
+            else:
+                converted_files = self._converted_files(variable)
+
+            grib_short_name = grib_index.grib_short_names([variable])[variable]
+            for grib_file_path, _, _, mtime, size in grib_index.list_files(variable):
+                filename = os.path.basename(grib_file_path)
+                if converted_files.get(filename) == [mtime, size]:
+                    continue
+
+                ds = self._decode_grib_file(grib_file_path, variable, grib_short_name)
+                self._write(ds, variable, overwrite=not converted_files)
+                converted_files[filename] = [mtime, size]
+                self._store_converted_files(variable, converted_files)
+                logger.info(f"Converted '{filename}' ({variable}) to Zarr")
+
+    def _decode_grib_file(self, grib_file_path, variable, grib_short_name):
+        ds = xr.open_dataset(
+            grib_file_path,
+            engine="cfgrib",
+            backend_kwargs={"filter_by_keys": {"shortName": grib_short_name}},
+        )
+        if "step" in ds[variable].dims:
+            raise ValueError(
+                f"'{grib_file_path}' has a step dimension for '{variable}', "
+                "only one forecast step per time is supported"
+            )
+        if "time" not in ds.dims:
+            ds = ds.expand_dims("time")
+
+        # keep the time dependent coordinates (e.g. valid_time) only
+        ds = ds[[variable]].drop_vars(
+            [
+                name for name in ds[variable].coords
+                if name not in ds.dims and "time" not in ds[name].dims
+            ]
+        )
+        return ds.drop_encoding().load()
+
+    def _write(self, ds, variable, overwrite):
+        if overwrite:
+            ds.to_zarr(
+                self.store_path,
+                group=variable,
+                mode="w",
+                encoding={
+                    variable: {
+                        "chunks": (
+                            self.time_chunk,
+                            self.spatial_chunk,
+                            self.spatial_chunk,
+                        )
+                    }
+                },
+            )
+            return
+
+        stored_times = xr.open_zarr(
+            self.store_path, group=variable, chunks=None
+        )["time"].values
+
+        if ds["time"].values.min() > stored_times.max():
+            ds.to_zarr(self.store_path, group=variable, append_dim="time")
+        elif set(ds["time"].values) <= set(stored_times):
+            # a file changed in place, overwrite its time steps
+            ds.drop_vars(["latitude", "longitude"]).to_zarr(
+                self.store_path, group=variable, region="auto"
+            )
+        else:
+            raise ValueError(
+                f"Time steps of '{variable}' cannot be appended in order, "
+                "rebuild the Zarr store to include them"
+            )
+
+    def _converted_files(self, variable):
+        group = zarr.open_group(self.store_path, path=variable, mode="r")
+        return dict(group.attrs.get("source_files", {}))
+
+    def _store_converted_files(self, variable, converted_files):
+        group = zarr.open_group(self.store_path, path=variable, mode="a")
+        group.attrs["source_files"] = converted_files
+
+    def read(self, variables, area, start_date, end_date):
+        """
+        Lazily open the store and load only the chunks that intersect
+        the area ([north, west, south, east]) and the date range.
+
+        Returns:
+            xarray.Dataset: The subset, or None if the store
+            does not hold the variables for the requested dates.
+        """
+        data_arrays = {}
+        for variable in variables:
+            if not self.has_variable(variable):
+                return None
+
+            ds = xr.open_zarr(self.store_path, group=variable, chunks=None)
+
+            # Only serve requests the store covers completely
+            stored_days = ds["time"].values.astype("datetime64[D]")
+            if (
+                stored_days.min() > np.datetime64(start_date.date())
+                or stored_days.max() < np.datetime64(end_date.date())
+            ):
+                return None
+
+            data_array = ds[variable].sel(
+                time=slice(
+                    start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+                ),
+                latitude=slice(area[0], area[2]),
+                longitude=slice(area[1], area[3]),
+            )
+            if data_array.size == 0:
+                return None
+            data_arrays[variable] = data_array.load()
+
+        return xr.Dataset(data_arrays)
@@ -21,6 +21,8 @@ class EOChatBot:
             st.session_state.past_request = []
         if "click" not in st.session_state:
             st.session_state.click = []
+        if "pending_jobs" not in st.session_state:
+            st.session_state.pending_jobs = []
 
         while len(st.session_state.click) < len(st.session_state.messages):
             st.session_state.click.insert(0, False)
@@ -122,6 +124,7 @@ class EOChatBot:
                     st.session_state.messages = []
                     st.session_state.past_request = []
                     st.session_state.click = []
+                    st.session_state.pending_jobs = []
                     st.rerun()
 
         # Process user input message
@@ -129,6 +132,9 @@ class EOChatBot:
             with st.chat_message("user"):
                 st.markdown(user_message)
             self.chatbot.process_request(user_message)
+        else:
+            # results of jobs that were still running at the last rerun
+            self.chatbot.show_pending_jobs()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+import sys
+import time
+
+from datetime import datetime
+
+from cda_classes import prompt_manager as prompt_manager_module
+from cda_classes.llm_processor import load_llm_processor
+from cda_classes.prompt_manager import PromptManager
+from cda_classes.response_cache import AgentResponseCache
+from utils.utils import Utilities
+
+# Compares the LLM backends on the prompts of yaml/tests.yaml: generated tokens
+# per second, latency and accuracy of the extracted product and time range.
+# Usage (from the repository root): python tests/llm_backend_benchmark.py transformers llama_cpp
+
+
+def expected_timeframe(expected):
+    # "last year" depends on the day the benchmark runs
+    current_year = datetime.now().year
+    return expected["timeframe"].format(
+        last_year=current_year - 1, current_year=current_year
+    )
+
+
+def run_benchmark(backend, tests):
+    llm = load_llm_processor(backend)
+    prompt_manager = PromptManager(llm)
+    # answers must come from the backend, not from the response cache
+    prompt_manager_module.AGENT_RESPONSE_CACHE = AgentResponseCache(max_entries=0)
+
+    generation_time = 0
+    correct_products = 0
+    correct_timeframes = 0
+    tokens_before = llm.generated_tokens
+
+    for name, test in tests.items():
+        start = time.perf_counter()
+        information = prompt_manager.retrieve_combined_information(test["user_prompt"])
+        generation_time += time.perf_counter() - start
+
+        expected = test["expected_response"]
+        if information is None:
+            print(f"{backend} | {name}: no valid answer")
+            continue
+
+        products = [str(product).lower() for product in information["climate_data"]]
+        if expected["product_type"] in products:
+            correct_products += 1
+
+        time_ranges = information["time_ranges"]
+        if time_ranges != ["None"]:
+            timeframe = f"{time_ranges[0][0][-4:]}-{time_ranges[0][1][-4:]}"
+            if timeframe == expected_timeframe(expected):
+                correct_timeframes += 1
+
+        print(f"{backend} | {name}: {information}")
+
+    generated_tokens = llm.generated_tokens - tokens_before
+    return {
+        "backend": backend,
+        "tokens_per_second": generated_tokens / generation_time if generation_time else 0.0,
+        "seconds_per_prompt": generation_time / len(tests),
+        "product_accuracy": correct_products / len(tests),
+        "timeframe_accuracy": correct_timeframes / len(tests),
+    }
+
+
+if __name__ == "__main__":
+    backends = sys.argv[1:] or ["transformers"]
+    tests = Utilities.load_config_file("yaml/tests.yaml")["tests"]
+
+    results = [run_benchmark(backend, tests) for backend in backends]
+
+    print(f"\n{'backend':<14}{'tokens/s':>10}{'s/prompt':>10}{'product':>10}{'timeframe':>11}")
+    for result in results:
+        print(
+            f"{result['backend']:<14}"
+            f"{result['tokens_per_second']:>10.1f}"
+            f"{result['seconds_per_prompt']:>10.2f}"
+            f"{result['product_accuracy']:>10.0%}"
+            f"{result['timeframe_accuracy']:>11.0%}"
+        )
@@ -0,0 +1,59 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from api.server import PipelineServer
+from cda_classes.job_manager import JobManager
+from cda_classes.pipeline_service import ClimateDataService
+
+# Usage (from the repository root): python -m pytest tests/test_api_server.py
+
+
+# Service without models, the prompt path fails like a bug in the pipeline
+class FakeService(ClimateDataService):
+    def __init__(self):
+        pass
+
+    def prepare_request(self, user_prompt, previous_request=None, on_field=None):
+        raise KeyError("location")
+
+
+@pytest.fixture
+def server_url():
+    server = PipelineServer(("127.0.0.1", 0), FakeService(), JobManager(max_workers=1))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body):
+    data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, method="POST")) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.mark.parametrize(
+    "body, status",
+    [
+        (b"not json", 400),
+        ([1, 2], 400),
+        ({"prompt": 3}, 400),
+        ({"request": "Berlin"}, 400),
+        ({"request": {"location": ["Berlin"], "time_ranges": [["32/01/2020", "31/12/2020"]]}}, 422),
+        ({"request": {"location": ["Berlin"], "time_ranges": ["01/01/2020"]}}, 422),
+        ({"prompt": "Temperature in Berlin"}, 422),
+    ],
+)
+def test_malformed_requests_get_a_json_error(server_url, body, status):
+    response_status, response = post(f"{server_url}/requests", body)
+
+    assert response_status == status
+    assert "error" in response
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from cda_classes.analysis_handler import BatchStatistics
+
+# Usage (from the repository root): python -m pytest tests/test_batch_statistics.py
+
+
+def assert_matches_pandas(series_list):
+    statistics = BatchStatistics(series_list)
+    for idx, series in enumerate(series_list):
+        reference = pd.Series(series, dtype=np.float64)
+        np.testing.assert_allclose(statistics.minimum[idx], reference.min())
+        np.testing.assert_allclose(statistics.maximum[idx], reference.max())
+        np.testing.assert_allclose(statistics.mean[idx], reference.mean())
+        np.testing.assert_allclose(statistics.std[idx], reference.std())
+        np.testing.assert_allclose(statistics.range[idx], reference.max() - reference.min())
+
+
+def test_series_of_different_length():
+    assert_matches_pandas([np.array([1.0, 4.0, 2.5]), np.array([3.0, np.nan, -1.0, 7.0, 0.5])])
+
+
+def test_all_nan_series():
+    assert_matches_pandas([np.array([np.nan, np.nan]), np.array([2.0, 5.0])])
+
+
+def test_empty_series():
+    assert_matches_pandas([np.array([]), np.array([])])
+    assert_matches_pandas([np.array([]), np.array([1.0])])
@@ -0,0 +1,128 @@
+import time
+import pickle
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from data_handler.cds import cds as cds_module
+from data_handler.cds.cds import ClimateDataStorageHandler
+from utils.utils import SubRequest, TimeSpan
+
+# Usage (from the repository root): python -m pytest tests/test_cds_downloader.py
+
+AACHEN = [51.0, 5.6, 50.5, 6.6]
+MADRID = [40.7, -4.0, 40.2, -3.4]
+OSLO = [60.2, 10.4, 59.7, 11.0]
+
+
+# Local stand-in for the CDS: every area has a delay, a number of transient
+# failures and may fail for good. Downloads write the area into a pickle.
+class FakeCds():
+    def __init__(self, delays, transient_failures=None, hard_failures=()):
+        self.delays = delays
+        self.transient_failures = dict(transient_failures or {})
+        self.hard_failures = set(hard_failures)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def client(self):
+        return FakeClient(self)
+
+
+class FakeClient():
+    def __init__(self, fake_cds):
+        self.fake_cds = fake_cds
+
+    def retrieve(self, name, request):
+        fake_cds = self.fake_cds
+        area = tuple(request["area"])
+        with fake_cds._lock:
+            fake_cds.calls.append(area)
+            failing = fake_cds.transient_failures.get(area, 0) > 0
+            if failing:
+                fake_cds.transient_failures[area] -= 1
+        time.sleep(fake_cds.delays.get(area, 0))
+        if area in fake_cds.hard_failures:
+            raise RuntimeError(f"request for {area} rejected")
+        if failing:
+            raise ConnectionError(f"transient error for {area}")
+        return FakeResult(request)
+
+
+class FakeResult():
+    def __init__(self, request):
+        self.request = request
+
+    def download(self, target):
+        north, west, south, east = self.request["area"]
+        times = pd.date_range("2020-01-01", "2020-01-31", freq="D")
+        dataset = xr.Dataset(
+            {"2t": (("time", "latitude", "longitude"), np.full((len(times), 2, 2), north))},
+            coords={"time": times, "latitude": [north, south], "longitude": [west, east]},
+        )
+        with open(target, "wb") as target_file:
+            pickle.dump(dataset, target_file)
+
+
+def unpickle(file):
+    with open(file, "rb") as dataset_file:
+        return pickle.load(dataset_file)
+
+
+def make_handler(fake_cds, tmp_path, monkeypatch, max_concurrent_jobs=3):
+    monkeypatch.setattr(cds_module, "CDS_CACHE_FOLDER", str(tmp_path))
+    handler = ClimateDataStorageHandler(
+        client_factory=fake_cds.client,
+        max_concurrent_jobs=max_concurrent_jobs,
+        retry_backoff_seconds=0,
+    )
+    handler.requests = [dict(handler.cds_request["request"])]
+    handler.process = unpickle
+    return handler
+
+
+def sub_requests():
+    return [
+        SubRequest(f"location {idx}", area, area, TimeSpan("01/01/2020", "31/01/2020"), "2t", idx)
+        for idx, area in enumerate([AACHEN, MADRID, OSLO])
+    ]
+
+
+def test_out_of_order_downloads_with_transient_failures(tmp_path, monkeypatch):
+    # the first request finishes last, the second fails twice before it succeeds
+    fake_cds = FakeCds(
+        delays={tuple(AACHEN): 0.3, tuple(MADRID): 0.0, tuple(OSLO): 0.1},
+        transient_failures={tuple(MADRID): 2},
+    )
+    handler = make_handler(fake_cds, tmp_path, monkeypatch)
+    progress = []
+    requests = sub_requests()
+
+    handler.get_data(requests, lambda finished, total: progress.append((finished, total)))
+
+    for request in requests:
+        assert request.data is not None
+        assert np.all(request.data.values == request.abbox[0])
+    assert fake_cds.calls.count(tuple(MADRID)) == 3
+    assert fake_cds.calls.count(tuple(AACHEN)) == 1
+    assert progress == [(1, 3), (2, 3), (3, 3)]
+
+
+def test_hard_failure_cancels_pending_downloads(tmp_path, monkeypatch):
+    fake_cds = FakeCds(
+        delays={tuple(AACHEN): 0.0, tuple(MADRID): 2.0, tuple(OSLO): 0.0},
+        hard_failures=[tuple(AACHEN)],
+    )
+    handler = make_handler(fake_cds, tmp_path, monkeypatch, max_concurrent_jobs=2)
+    handler.max_retries = 1
+
+    start = time.perf_counter()
+    with pytest.raises(RuntimeError):
+        handler.get_data(sub_requests())
+
+    # neither waits for the slow download nor starts the queued one
+    assert time.perf_counter() - start < 1.5
+    assert tuple(OSLO) not in fake_cds.calls
@@ -0,0 +1,44 @@
+from cda_classes import eorequest as eorequest_module
+from cda_classes.eorequest import EORequest
+from cda_classes.geocoder import GeocodeCache, Geocoder
+
+# Usage (from the repository root): python -m pytest tests/test_geocoder.py
+
+BOUNDING_BOXES = {"Aachen": [50.7, 50.8, 6.0, 6.2], "Madrid": [40.3, 40.6, -3.9, -3.5]}
+
+
+# Resolves the known places, raises like a failing Nominatim for "Offline"
+class FakeGeocoder(Geocoder):
+    def resolve(self, location):
+        if location == "Offline":
+            raise ConnectionError("Nominatim is not reachable")
+        return BOUNDING_BOXES.get(location)
+
+
+def make_geocoder(tmp_path):
+    return FakeGeocoder(
+        cache=GeocodeCache(str(tmp_path / "geocode_cache.sqlite")),
+        gazetteer_path=str(tmp_path / "missing.tsv"),
+    )
+
+
+def test_resolve_many_reports_each_location(tmp_path):
+    results = make_geocoder(tmp_path).resolve_many(["Aachen", "Atlantis", "Offline", "Madrid"])
+
+    assert results[0] == (BOUNDING_BOXES["Aachen"], None)
+    assert results[1][0] is None and "no match" in results[1][1]
+    assert results[2][0] is None and "not reachable" in results[2][1]
+    assert results[3] == (BOUNDING_BOXES["Madrid"], None)
+
+
+def test_failed_location_keeps_the_others(tmp_path, monkeypatch):
+    monkeypatch.setattr(eorequest_module, "GEOCODER", make_geocoder(tmp_path))
+    request = EORequest()
+    request.request_analysis = ["comparison"]
+    request.request_locations = ["Aachen", "Offline", "Madrid"]
+
+    request.post_process_request_variables()
+
+    assert request.request_locations == ["Aachen", "Madrid"]
+    assert request.unresolved_locations == ["Offline"]
+    assert len(request.adjusted_bounding_box) == 2
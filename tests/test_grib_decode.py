@@ -0,0 +1,38 @@
+import numpy as np
+import xarray as xr
+
+from data_handler import data_handler as data_handler_module
+from data_handler.data_handler import decode_grib_file, group_areas
+
+# Usage (from the repository root): python -m pytest tests/test_grib_decode.py
+
+LISBON = [40.2, -10.6, 37.2, -7.6]
+TOKYO = [37.2, 138.2, 34.2, 141.2]
+PORTO = [42.6, -10.1, 39.6, -7.1]
+
+
+def global_dataset():
+    latitude = np.round(np.arange(60.0, 20.0, -0.5), 1)
+    longitude = np.round(np.arange(-20.0, 150.0, 0.5), 1)
+    values = np.add.outer(latitude, longitude)
+    return xr.Dataset(
+        {"t2m": (("latitude", "longitude"), values)},
+        coords={"latitude": latitude, "longitude": longitude},
+    )
+
+
+def test_distant_areas_are_read_separately():
+    assert group_areas([LISBON, TOKYO, PORTO]) == [[0, 2], [1]]
+
+
+def test_decoded_areas_keep_their_order(monkeypatch):
+    dataset = global_dataset()
+    monkeypatch.setattr(data_handler_module.xr, "open_dataset", lambda *args, **kwargs: dataset)
+
+    decoded = decode_grib_file("file.grib", ["2t"], ["t2m"], [LISBON, TOKYO, PORTO])
+
+    for area, decoded_area in zip([LISBON, TOKYO, PORTO], decoded):
+        expected = dataset[["t2m"]].sel(
+            latitude=slice(area[0], area[2]), longitude=slice(area[1], area[3])
+        )
+        xr.testing.assert_identical(decoded_area, expected)
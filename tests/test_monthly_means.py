@@ -0,0 +1,42 @@
+import pytest
+
+from cda_classes.eorequest import EORequest
+from data_handler.cds.cds import ClimateDataStorageHandler
+from utils.utils import SubRequest, TimeSpan
+
+# Usage (from the repository root): python -m pytest tests/test_monthly_means.py
+
+
+class FakeClient():
+    pass
+
+
+def long_request(variable_short_name, analysis="basic_analysis"):
+    request = EORequest()
+    request.variable_short_name = variable_short_name
+    request.request_analysis = [analysis]
+    area = [51.0, 5.6, 50.5, 6.6]
+    request.collected_sub_requests = [
+        SubRequest("Aachen", area, area, TimeSpan("01/01/2010", "31/12/2020"), variable_short_name, 0)
+    ]
+    return request
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the download cache folder is relative
+    return ClimateDataStorageHandler(client_factory=FakeClient)
+
+
+@pytest.mark.parametrize("variable_short_name", ["t2m", "skt", "sde"])
+def test_long_requests_of_instantaneous_variables_use_monthly_means(handler, variable_short_name):
+    assert handler.use_monthly_means(long_request(variable_short_name))
+
+
+@pytest.mark.parametrize("variable_short_name", ["tp", "e", "w10"])
+def test_accumulated_variables_and_wind_stay_hourly(handler, variable_short_name):
+    assert not handler.use_monthly_means(long_request(variable_short_name))
+
+
+def test_predictions_stay_hourly(handler):
+    assert not handler.use_monthly_means(long_request("t2m", "predictions"))
@@ -0,0 +1,38 @@
+import torch
+
+from cda_classes.prototype_classifier import PrototypeClassifier
+
+# Usage (from the repository root): python -m pytest tests/test_prototype_classifier.py
+
+KEYWORDS = ["temperature", "wind", "precipitation", "evaporation", "snow", "vegetation"]
+
+
+# Embeds a text by the keywords it contains, plus a small shared component
+class KeywordEncoder():
+    def encode(self, texts, convert_to_tensor=True):
+        return torch.tensor(
+            [
+                [0.1] + [float(keyword in text.lower()) for keyword in KEYWORDS]
+                for text in texts
+            ]
+        )
+
+
+def test_products_are_restricted_to_the_product_agent():
+    classifier = PrototypeClassifier(KeywordEncoder())
+    labels, _ = classifier.prototypes["product_agent"]
+
+    assert set(labels) == {"Temperature", "Wind", "Precipitation", "Evaporation", "Snow"}
+    assert classifier.classify("product_agent", "vegetation in Brazil 2020") != ["Vegetation"]
+
+
+def test_single_product_is_answered():
+    classifier = PrototypeClassifier(KeywordEncoder())
+
+    assert classifier.classify("product_agent", "temperature in Berlin 2020") == ["Temperature"]
+
+
+def test_several_products_are_left_to_the_llm():
+    classifier = PrototypeClassifier(KeywordEncoder())
+
+    assert classifier.classify("product_agent", "temperature and wind in Berlin 2020") is None
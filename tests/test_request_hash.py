@@ -0,0 +1,29 @@
+from cda_classes.eorequest import EORequest
+from utils.utils import TimeSpan
+
+# Usage (from the repository root): python -m pytest tests/test_request_hash.py
+
+
+def prediction_request(end_date):
+    request = EORequest()
+    request.request_locations = ["Paris"]
+    request.adjusted_bounding_box = [[49.0, 2.0, 48.6, 2.6]]
+    request.request_timeframes = [TimeSpan("01/01/2025", end_date)]
+    request.request_analysis = ["predictions"]
+    request.variable_short_name = "2t"
+    # pins the data window to 01/01/2021-31/12/2023
+    request._check_timeframe_and_modify()
+    return request
+
+
+def test_prediction_horizon_changes_hash():
+    until_2026 = prediction_request("31/12/2026")
+    until_2030 = prediction_request("31/12/2030")
+
+    assert until_2026.request_timeframes[0].startdate_str == until_2030.request_timeframes[0].startdate_str
+    assert until_2026.request_timeframes[0].enddate_str == until_2030.request_timeframes[0].enddate_str
+    assert until_2026.request_hash() != until_2030.request_hash()
+
+
+def test_identical_requests_share_hash():
+    assert prediction_request("31/12/2026").request_hash() == prediction_request("31/12/2026").request_hash()
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+from data_handler.cds.request_planner import CdsRequestPlanner
+from utils.utils import SubRequest, TimeSpan
+
+# Usage (from the repository root): python -m pytest tests/test_request_planner.py
+
+
+def sub_request(abbox, start_date, end_date, id_request=0):
+    return SubRequest("location", abbox, abbox, TimeSpan(start_date, end_date), "2t", id_request)
+
+
+def planned_dates(planned_request):
+    dates = set()
+    for year in planned_request.years:
+        for month in planned_request.months:
+            for day in planned_request.days:
+                try:
+                    dates.add(datetime(year, month, day))
+                except ValueError:
+                    pass  # e.g. 31/11
+    return dates
+
+
+def requested_dates(request):
+    timeframe = request.timeframe_object
+    return {
+        timeframe.startdate + timedelta(days=offset)
+        for offset in range((timeframe.enddate - timeframe.startdate).days + 1)
+    }
+
+
+def test_cross_year_request_is_not_widened():
+    request = sub_request([50.0, 6.0, 49.0, 7.0], "15/11/2020", "15/02/2021")
+    planned_requests = CdsRequestPlanner().plan([request])
+
+    fetched_dates = set().union(*(planned_dates(planned) for planned in planned_requests))
+    assert requested_dates(request) <= fetched_dates
+
+    # the per-month requests fetched exactly these 93 days
+    fetched_size = sum(planned.size() for planned in planned_requests)
+    assert fetched_size <= 1.25 * 93
+
+
+def test_adjacent_boxes_are_merged():
+    west = sub_request([50.0, 6.0, 49.0, 7.0], "01/01/2020", "31/12/2020", 0)
+    east = sub_request([50.0, 7.0, 49.0, 8.0], "01/01/2020", "31/12/2020", 1)
+    planned_requests = CdsRequestPlanner().plan([west, east])
+
+    assert len(planned_requests) == 1
+    assert planned_requests[0].area == [50.0, 6.0, 49.0, 8.0]
+    assert len(planned_requests[0].sub_requests) == 2
+
+
+def test_distant_boxes_stay_separate():
+    aachen = sub_request([51.0, 5.6, 50.5, 6.6], "01/01/2020", "31/12/2020", 0)
+    madrid = sub_request([40.7, -4.0, 40.2, -3.4], "01/01/2020", "31/12/2020", 1)
+    planned_requests = CdsRequestPlanner().plan([aachen, madrid])
+
+    assert len(planned_requests) == 2
+    assert sorted(planned.area[0] for planned in planned_requests) == [40.7, 51.0]